@@ -0,0 +1,220 @@
+import asyncio
+
+import serial
+
+from .devices.parser import FrameParser
+
+
+# Asyncio transport and device API
+#
+# The blocking device API waits on ser.read with fixed timeouts, which makes it
+# impossible to talk to more than one gateway per thread. This module offers
+# the same operations as coroutines on top of a GecoProtocol, which collects the
+# bytes received from a socket:// endpoint (asyncio TCP connection) or a local
+# serial port (non-blocking pyserial port registered with the event loop) and
+# lets frame readers await exactly the number of bytes a frame still needs.
+#
+# Example:
+#
+#   conn = await openConnection('socket://192.168.12.34:8899')
+#   dev = PCWU(1, 1, 2, 2, onMessage)
+#   await readStatusRegisters(dev, conn)
+#   conn.close()
+#
+
+class GecoProtocol(asyncio.Protocol):
+
+    def __init__(self):
+        self.transport = None
+        self.buf = bytearray()      # Received but not yet consumed bytes
+        self.waiter = None          # Future a reader is waiting on for more bytes
+        self.lost = None            # Exception to raise once connection is lost
+        self.lock = asyncio.Lock()  # One transaction on the bus at a time
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buf += data
+        self._wakeup()
+
+    def connection_lost(self, exc):
+        self.lost = exc or ConnectionResetError("Connection lost")
+        self._wakeup()
+
+    def _wakeup(self):
+        waiter = self.waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def readexactly(self, n):
+        while len(self.buf) < n:
+            if self.lost:
+                raise self.lost
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    # Discard all received bytes, like flushInput on a serial port
+    def flushInput(self):
+        del self.buf[:]
+
+    def write(self, data):
+        if self.lost:
+            raise self.lost
+        self.transport.write(data)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    # Read the next frame which is valid for dev; returns (h, sh, frame).
+    # Uses the parser of dev unless another one is given.
+    async def readFrame(self, dev, timeout=None, parser=None):
+        if parser is None:
+            parser = dev.parser
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            for frame in parser.parse():
+                return frame
+            remaining = None if deadline is None else max(0, deadline - loop.time())
+            data = await asyncio.wait_for(self.readexactly(parser.needed()), remaining)
+            parser.feed(data)
+
+
+# Minimal asyncio transport for a local serial port
+class SerialTransport(asyncio.Transport):
+
+    def __init__(self, loop, protocol, ser):
+        super().__init__()
+        self.loop = loop
+        self.protocol = protocol
+        self.ser = ser
+        self.closing = False
+        loop.add_reader(ser.fileno(), self._read)
+        loop.call_soon(protocol.connection_made, self)
+
+    def _read(self):
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except serial.SerialException as e:
+            self._close(e)
+            return
+        if data:
+            self.protocol.data_received(data)
+
+    def write(self, data):
+        try:
+            self.ser.write(data)
+        except serial.SerialException as e:
+            self._close(e)
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        self._close(None)
+
+    def _close(self, exc):
+        if self.closing:
+            return
+        self.closing = True
+        self.loop.remove_reader(self.ser.fileno())
+        self.ser.close()
+        self.loop.call_soon(self.protocol.connection_lost, exc)
+
+
+async def openConnection(addr, serialParameters=None):
+    loop = asyncio.get_running_loop()
+    if addr.startswith("socket://"):
+        host, port = addr[len("socket://"):].rsplit(":", 1)
+        _, protocol = await loop.create_connection(GecoProtocol, host, int(port))
+    else:
+        ser = serial.Serial(addr, timeout=0, **(serialParameters or {}))
+        protocol = GecoProtocol()
+        SerialTransport(loop, protocol, ser)
+        await asyncio.sleep(0)  # let connection_made run
+    return protocol
+
+
+# Async device API; mirrors the blocking methods of BaseDevice
+##############################################################
+
+RESPONSE_TIMEOUT = 0.4
+
+async def _transaction(dev, conn, m, onMessage, timeout):
+    if onMessage is None:
+        onMessage = dev.onMessage
+    async with conn.lock:
+        conn.flushInput()
+        dev.parser.reset()
+        conn.write(m)
+        # Frames before the response (eg. an echo of the request) are passed on as well
+        while True:
+            try:
+                h, sh, frame = await conn.readFrame(dev, timeout)
+            except asyncio.TimeoutError:
+                raise Exception("No response from device within %.1fs; %s" % (timeout, dev.parser.lastError))
+            dev.dispatchFrame(h, sh, frame, onMessage)
+            if dev.isResponse(h):
+                return h, sh
+
+async def readRegisters(dev, conn, start, num, onMessage=None, timeout=RESPONSE_TIMEOUT):
+    return await _transaction(dev, conn, dev.createReadRegistersMessage(start, num), onMessage, timeout)
+
+async def readRegister(dev, conn, reg, onMessage=None, timeout=RESPONSE_TIMEOUT):
+    return await readRegisters(dev, conn, reg, 2, onMessage=onMessage, timeout=timeout)
+
+async def readStatusRegisters(dev, conn, onMessage=None, timeout=RESPONSE_TIMEOUT):
+    start = dev.REG_STATUS_START
+    return await readRegisters(dev, conn, start, dev.REG_CONFIG_START - start, onMessage=onMessage, timeout=timeout)
+
+async def readConfigRegisters(dev, conn, onMessage=None, timeout=RESPONSE_TIMEOUT):
+    start = dev.REG_CONFIG_START
+    while start < dev.REG_MAX_ADR:
+        num = min(dev.REG_MAX_ADR + 2 - start, dev.REG_MAX_NUM)
+        await readRegisters(dev, conn, start, num, onMessage=onMessage, timeout=timeout)
+        start = start + num
+
+async def writeRegisters(dev, conn, start, num, values, onMessage=None, timeout=RESPONSE_TIMEOUT):
+    return await _transaction(dev, conn, dev.createWriteRegistersMessage(start, num, values), onMessage, timeout)
+
+async def writeRegister(dev, conn, reg, val, onMessage=None, timeout=RESPONSE_TIMEOUT):
+    return await _transaction(dev, conn, dev.createWriteRegisterMessage(reg, val), onMessage, timeout)
+
+# Process all messages in X cycles of device to controller comms; see eavesDrop in
+# BaseDevice for a description of the cycle. A cycle starts with the device
+# reading 20 registers from address 100 and ends when the bus goes quiet.
+async def eavesDrop(dev, conn, numCycles=None, onMessage=None, syncTimeout=1.0, gapTime=0.1):
+    if onMessage is None:
+        onMessage = dev.onMessage
+    parser = FrameParser(dev)   # Not dev.parser, which transactions reset and feed
+    cnt = 0
+    while True:
+        # The bus is held for one cycle at a time; other coroutines get their
+        # turn in the gap after it
+        async with conn.lock:
+            parser.reset()
+            inCycle = False
+            while True:
+                try:
+                    h, sh, frame = await conn.readFrame(dev, gapTime if inCycle else syncTimeout, parser)
+                except asyncio.TimeoutError:
+                    if not inCycle:
+                        raise Exception("No start of cycle within %.1fs" % syncTimeout)
+                    break
+                if h["From"] == dev.devHardId and sh["FNC"] == 0x40 and sh["RegStart"] == 100:
+                    if inCycle and numCycles is not None and cnt >= numCycles:
+                        return cnt
+                    inCycle = True
+                    cnt += 1
+                if inCycle:
+                    dev.dispatchFrame(h, sh, frame, onMessage)
+        if numCycles is not None and cnt >= numCycles:
+            return cnt
@@ -0,0 +1,192 @@
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError("hewalex_geco.batch needs numpy; install it with 'pip install numpy'") from e
+
+from .capture import CaptureReader, RAW
+from .crc import CRC8_TABLE, CRC16_TABLE
+from .devices.parser import FrameParser
+
+
+# Columnar batch decoding of recorded traffic
+#
+# Decoding days of captured frames one parseRegisters call at a time builds
+# millions of small dicts. Frames with the same (FNC, RegStart, RegLen) layout
+# can instead be stacked into a 2-D uint8 array, one frame per row, and every
+# register decoded into a typed column in one vectorized operation, using the
+# offsets of the device's decode plan. CRCs are validated over all rows at once
+# with the same tables as crc8 and crc16, one column of bytes at a time.
+#
+# Columns are keyed like parseRegisters. Values are numpy arrays: temperatures
+# and scaled values as float64, word/rwrd as uint16, dwrd as uint32, bool and
+# mask bits as bool, date as datetime64[D], time as timedelta64[s] since
+# midnight and time programs as (rows, 24) bool arrays. Unsupported register
+# types give an object column of None.
+#
+# Needs numpy, which the rest of the package doesn't (see the optional part of
+# requirements.txt); import it for analytics only.
+#
+# Example:
+#
+#   for (fnc, start, num), (times, cols) in decodeCapture(PCWU(1, 1, 2, 2), 'pcwu.cap').items():
+#       print(start, num, len(times), cols['T1'].mean())
+#
+
+HARD_HEADER_LEN = 8
+SOFT_HEADER_END = 18        # Payload starts here
+MIN_FRAME_LEN = 20          # Hard header, soft header and CRC16
+
+_CRC8 = np.array(CRC8_TABLE, dtype=np.uint8)
+_CRC16 = np.array(CRC16_TABLE, dtype=np.uint16)
+
+
+# 2-D uint8 array of frames (or payloads) of equal length, one per row
+def stackFrames(frames):
+    frames = list(frames)
+    if not frames:
+        return np.zeros((0, 0), dtype=np.uint8)
+    size = len(frames[0])
+    if any(len(frame) != size for frame in frames):
+        raise Exception("Frames differ in length")
+    return np.frombuffer(b''.join(frames), dtype=np.uint8).reshape(len(frames), size)
+
+# CRCs of all rows at once. The table driven update is done for one column of
+# bytes of all rows at a time, in place; columns are made contiguous first.
+def crc8Rows(rows):
+    accum = np.zeros(len(rows), dtype=np.uint8)
+    idx = np.empty(len(rows), dtype=np.uint8)
+    for col in np.ascontiguousarray(rows.T):
+        np.bitwise_xor(accum, col, out=idx)
+        np.take(_CRC8, idx, out=accum)
+    return accum
+
+def crc16Rows(rows):
+    accum = np.zeros(len(rows), dtype=np.uint16)
+    idx = np.empty(len(rows), dtype=np.uint16)
+    val = np.empty(len(rows), dtype=np.uint16)
+    for col in np.ascontiguousarray(rows.T):
+        np.right_shift(accum, 8, out=idx)
+        np.bitwise_xor(idx, col, out=idx)
+        np.take(_CRC16, idx, out=val)
+        np.left_shift(accum, 8, out=accum)
+        np.bitwise_xor(accum, val, out=accum)
+    return accum
+
+# Bool array telling which rows of stacked frames have a valid start byte,
+# hard header CRC8 and soft message CRC16
+def validRows(rows):
+    if rows.shape[1] < MIN_FRAME_LEN:
+        return np.zeros(len(rows), dtype=bool)
+    crc16 = (rows[:, -2].astype(np.uint16) << 8) | rows[:, -1]
+    return (
+        (rows[:, 0] == 0x69) &
+        (crc8Rows(rows[:, :HARD_HEADER_LEN - 1]) == rows[:, HARD_HEADER_LEN - 1]) &
+        (crc16Rows(rows[:, HARD_HEADER_LEN:-2]) == crc16)
+    )
+
+def _u16(p, adr):
+    return p[:, adr].astype(np.uint16) | (p[:, adr + 1].astype(np.uint16) << 8)
+
+def _u32(p, adr):
+    return _u16(p, adr).astype(np.uint32) | (_u16(p, adr + 2).astype(np.uint32) << 16)
+
+def _i16(p, adr):
+    return _u16(p, adr).view(np.int16)
+
+def _date(p, adr):
+    months = (p[:, adr].astype(np.int64) + 30) * 12 + p[:, adr + 1] - 1     # Since 1970-01
+    return months.astype('datetime64[M]').astype('datetime64[D]') + (p[:, adr + 2].astype(np.int64) - 1).astype('timedelta64[D]')
+
+def _time(p, adr):
+    seconds = p[:, adr].astype(np.int64) * 3600 + p[:, adr + 1].astype(np.int64) * 60 + p[:, adr + 2]
+    return seconds.astype('timedelta64[s]')
+
+def _rwrd(p, adr):
+    return p[:, adr + 1].astype(np.uint16) | (p[:, adr].astype(np.uint16) << 8)
+
+def _tprg(p, adr):
+    return ((_u32(p, adr)[:, None] >> np.arange(24, dtype=np.uint32)) & 1).astype(bool)
+
+# Register type => column decoder, called as decoder(payloads, offset)
+COLUMN_TYPES = {
+    'date': _date,
+    'time': _time,
+    'word': _u16,
+    'rwrd': _rwrd,
+    'dwrd': _u32,
+    'temp': lambda p, adr: _i16(p, adr) / 1.0,
+    'te10': lambda p, adr: _i16(p, adr) / 10.0,
+    'fl10': lambda p, adr: _u16(p, adr) / 10.0,
+    'f100': lambda p, adr: _u16(p, adr) / 100.0,
+    'bool': lambda p, adr: _u16(p, adr) != 0,
+    'tprg': _tprg,
+}
+
+# Decode stacked payloads of (regstart, reglen) into a dict of columns
+def decodeRows(dev, payloads, regstart, reglen, unknown=False):
+    plan = dev.getDecodePlan(regstart, reglen, unknown)
+    width = payloads.shape[1]
+    if len(payloads) and (width != plan.size if plan.exact else width < plan.size):
+        raise Exception("Payloads of %d bytes don't match registers %d+%d" % (payloads.shape[1], regstart, reglen))
+    columns = {}
+    masks = {}
+    for name, (adr, field, conv, bit) in plan.fields.items():
+        reg = dev.getRegisterByNumber(regstart + adr)
+        if reg is None:
+            # Unknown register, decoded as word or trailing byte
+            columns[name] = _u16(payloads, adr) if field.size == 2 else payloads[:, adr].copy()
+        elif conv is None:
+            word = masks.get(adr)
+            if word is None:
+                word = masks[adr] = _u16(payloads, adr)
+            columns[name] = ((word >> bit) & 1).astype(bool)
+        elif reg['type'] in COLUMN_TYPES:
+            columns[name] = COLUMN_TYPES[reg['type']](payloads, adr)
+        else:
+            columns[name] = np.full(len(payloads), None, dtype=object)
+    return columns
+
+# Decode frames which all have the same FNC, RegStart and RegLen; frames with
+# invalid CRCs are dropped. Returns (columns, bool array of rows kept).
+def decodeFrames(dev, frames, unknown=False):
+    rows = stackFrames(frames)
+    if not len(rows):
+        return {}, np.zeros(0, dtype=bool)
+    if rows.shape[1] < MIN_FRAME_LEN:
+        raise Exception("Frames too short")
+    if (rows[:, 15] != rows[0, 15]).any() or (rows[:, 16:18] != rows[0, 16:18]).any():
+        raise Exception("Frames differ in register layout")
+    valid = validRows(rows)
+    regstart = (int(rows[0, 17]) << 8) | int(rows[0, 16])
+    payloads = rows[valid, SOFT_HEADER_END:-2]
+    return decodeRows(dev, payloads, regstart, int(rows[0, 15]), unknown), valid
+
+# Decode all frames sent by dev in a capture file, grouped by layout. Returns
+# a dict of (FNC, RegStart, RegLen) => (times, columns).
+def decodeCapture(dev, f, fncs=(0x50, 0x60), unknown=False):
+    groups = {}     # (FNC, RegStart, RegLen) => ([time], [frame])
+    parser = None
+    for t, kind, data in (f if isinstance(f, CaptureReader) else CaptureReader(f)):
+        if kind == RAW:
+            if parser is None:
+                parser = FrameParser(dev)
+            frames = [frame for h, sh, frame in parser.feed(data)]
+        else:
+            frames = (data,)
+        for frame in frames:
+            if len(frame) < MIN_FRAME_LEN or len(frame) != MIN_FRAME_LEN + frame[15]:
+                continue
+            if frame[2] != dev.devHardId or frame[12] not in fncs:
+                continue
+            key = (frame[12], frame[16] | (frame[17] << 8), frame[15])
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = ([], [])
+            group[0].append(t)
+            group[1].append(frame)
+
+    ret = {}
+    for key, (times, frames) in groups.items():
+        columns, valid = decodeFrames(dev, frames, unknown)
+        ret[key] = (np.array(times)[valid], columns)
+    return ret
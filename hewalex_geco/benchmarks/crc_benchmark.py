@@ -0,0 +1,62 @@
+import timeit
+
+
+# Compare table driven CRC engine to the original bitwise implementation
+from hewalex_geco.crc import crc8, crc16, Crc8, Crc16
+from hewalex_geco.benchmarks.frames import pcwuCycle, pcwuConfigResponse
+
+
+# Original bitwise implementation, kept here as reference
+def bitwise_crc8(buf):
+    accum = 0
+    for i in buf:
+        accum = accum ^ i
+        for _ in range(8):
+            if accum & 0x80:
+                accum = (((accum << 1) & 0xff) ^ 0xD5) & 0xff
+            else:
+                accum = (accum << 1) & 0xff
+    return accum
+
+def bitwise_crc16(buf):
+    accum = 0
+    for i in buf:
+        accum = accum ^ (i << 8)
+        for _ in range(8):
+            if accum & 0x8000:
+                accum = (((accum << 1) & 0xffff) ^ 0x1021) & 0xffff
+            else:
+                accum = (accum << 1) & 0xffff
+    return accum
+
+# Split frames in the parts the CRCs are calculated over, like the parser does
+frames = pcwuCycle() + [pcwuConfigResponse()]
+headers = [memoryview(f)[:7] for f in frames]
+payloads = [memoryview(f)[8:-2] for f in frames]
+numBytes = sum(len(h) + len(p) for h, p in zip(headers, payloads))
+
+for h, p in zip(headers, payloads):
+    assert crc8(h) == bitwise_crc8(h)
+    assert crc16(p) == bitwise_crc16(p)
+    assert Crc16().update(p[:5]).update(p[5:]).digest() == crc16(p)
+    assert Crc8(h).digest() == crc8(h)
+
+def runBitwise():
+    for h, p in zip(headers, payloads):
+        bitwise_crc8(h)
+        bitwise_crc16(p)
+
+def runTable():
+    for h, p in zip(headers, payloads):
+        crc8(h)
+        crc16(p)
+
+def runStreaming():
+    for h, p in zip(headers, payloads):
+        Crc8(h).digest()
+        Crc16(p).digest()
+
+number = 200
+for name, func in (('bitwise', runBitwise), ('table', runTable), ('streaming', runStreaming)):
+    t = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print("%-10s %8.1f us/batch %8.1f MB/s (%d frames, %d bytes)" % (name, t * 1e6, numBytes / t / 1e6, len(frames), numBytes))
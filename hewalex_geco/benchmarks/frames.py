@@ -0,0 +1,83 @@
+from binascii import unhexlify
+
+
+# Synthetic corpus of PCWU and ZPS frames, laid out like the frames on the
+# RS485 bus between a G-426/G-422 controller (hard/soft id 1) and a PCWU
+# executive module or ZPS (hard/soft id 2). They were built by hand, not
+# captured: headers, lengths and CRCs are valid, but register values are
+# made up. The controller registers are the bytes 0x30..0x43 and most status
+# registers cycle through 0..3. Good enough for timing the protocol code;
+# don't rely on them for device behaviour.
+
+PCWU_CYCLE = [
+    # 1. device reads 20 controller registers starting at 100
+    '6901028400000c8401000200408000146400f06e',
+    # 2. controller responds
+    '690201840000208502000100508000146400303132333435363738393a3b3c3d3e3f40414243a06f',
+    # 3. device writes its status registers 120..302 to the controller
+    '690102840000c25e01000200608000b6780015060e000d250500d7009c01f701ffffffff8101b9014e0070008c02'
+    '0100000002000000030003000300030001000300000003000000030003000000030002000100000002000000ffc1'
+    '02002508f2000000000000000000000000000300010003000000000000000000010003000300010002000100010003'
+    '000200000003000000010002000000020003000100020002000300030000000300010003000300010002000200000003'
+    '000000010003000200030000005f07',
+    # 4. controller acknowledges the write
+    '6902018400000cf602000100708000b6780033ba',
+    # 5. device reads 4 controller registers starting at 252
+    '6901028400000c840100020040800004fc00224f',
+    # 6. controller responds; display on, no changes
+    '69020184000010730200010050800004fc0010000000ecb7',
+]
+
+# Response of a PCWU to a direct read of its config registers 302..528
+PCWU_CONFIG_RESPONSE = (
+    '690102840000ee2d01000200508000e22e01020000000100f4013200500000f0ff0000f0ff0000f0ff000000000000'
+    '0002000200000001000200010002000100010001000200020002000200000001000200020000000200020000f0ff00'
+    '00f0ff0000f0ff00020000000200010001000100010001000000020000f0ff0000f0ff0000f0ff0000000000020000'
+    '0002000200000000f0ff0000f0ff0000f0ff0000000000010000000100000001000000020000000100010000000000'
+    '0000010002000000020001000200020001000100020001000100010000000000010001000100010000000100000001'
+    '000200020000000200699d'
+)
+
+# Response of a PCWU to a direct read of its status registers 120..302
+PCWU_STATUS_RESPONSE = (
+    '690102840000c25e01000200508000b6780015060e000d250500d7009c01f701ffffffff8101b9014e0070008c0201'
+    '00000002000000030003000300030001000300000003000000030003000000030002000100000002000000ffc10200'
+    '2508f20000000000000000000000000003000100030000000000000000000100030003000100020001000100030002'
+    '0000000300000001000200000002000300010002000200030003000000030001000300030001000200020000000300'
+    '000001000300020003000000e6ff'
+)
+
+# Response of a ZPS to a direct read of its status registers 120..170
+ZPS_STATUS_RESPONSE = (
+    '6901028400003e0d0100020050800032780015060e000c001e004000300034003700ffffffff00000000e204000023'
+    '0001003e0005000900000000000000000039300000a1d4'
+)
+
+# Responses of a ZPS to direct reads of its config registers 170..332, in
+# blocks of REG_MAX_NUM
+ZPS_CONFIG_RESPONSES = [
+    # 170..246
+    '69010284000058b5010002005080004caa00010003000800010001000100ecff00003c0000006400000001000700e5'
+    '070f000700e50700000800060050002d00000046004b0001000000b80b01005a00010000000000000001003c002300'
+    '1e2d',
+    # 246..322
+    '69010284000058b5010002005080004cf6000500c0ff3f00c0ff3f00c0ff3f00c0ff3f00c0ff3f00c0ff3f00000000'
+    '0000008403f00a0a000a00080000000100000000000000000000000000000000000000000040e2010000000000af01d541',
+    # 322..332
+    '6901028400001680010002005080000a4201010000002d0005000f0004ca',
+]
+
+def pcwuCycle():
+    return [unhexlify(f) for f in PCWU_CYCLE]
+
+def pcwuConfigResponse():
+    return unhexlify(PCWU_CONFIG_RESPONSE)
+
+def pcwuStatusResponse():
+    return unhexlify(PCWU_STATUS_RESPONSE)
+
+def zpsStatusResponse():
+    return unhexlify(ZPS_STATUS_RESPONSE)
+
+def zpsConfigResponses():
+    return [unhexlify(f) for f in ZPS_CONFIG_RESPONSES]
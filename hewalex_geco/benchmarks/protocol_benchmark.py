@@ -0,0 +1,142 @@
+import argparse
+import json
+import platform
+import timeit
+import tracemalloc
+
+
+# Microbenchmarks of the protocol hot paths
+#
+# Runs every benchmark on the frame corpus and reports operations per second,
+# and the peak number of bytes allocated during one call. Results can be saved
+# as JSON and compared to a previous run:
+#
+#   python -m hewalex_geco.benchmarks.protocol_benchmark --json before.json
+#   ... change something ...
+#   python -m hewalex_geco.benchmarks.protocol_benchmark --baseline before.json
+#
+from hewalex_geco.crc import crc8, crc16
+from hewalex_geco.devices import PCWU, ZPS
+from hewalex_geco.benchmarks.frames import pcwuCycle, pcwuConfigResponse, pcwuStatusResponse, zpsStatusResponse, zpsConfigResponses
+
+
+def onMessage(dev, h, sh, m):
+    pass
+
+# Benchmarks as a list of (name, func) where func takes no arguments
+def setupBenchmarks():
+    pcwu = PCWU(1, 1, 2, 2, onMessage)
+    zps = ZPS(1, 1, 2, 2, onMessage)
+
+    status = pcwuStatusResponse()
+    config = pcwuConfigResponse()
+    cycle = b''.join(pcwuCycle())
+    zpsStatus = zpsStatusResponse()
+    zpsConfig = zpsConfigResponses()
+    zpsAll = zpsStatus + b''.join(zpsConfig)
+
+    header = memoryview(status)[:7]
+    payload = memoryview(status)[8:-2]
+    h = pcwu.parseHardHeader(status)
+    soft = memoryview(status)[8:]
+    statusData = memoryview(status)[18:-2]
+    configData = memoryview(config)[18:-2]
+    zpsStatusData = memoryview(zpsStatus)[18:-2]
+    zpsConfigData = memoryview(zpsConfig[0])[18:-2]
+    values = list(range(40))
+
+    def parseSoftHeaderValidate():
+        sh = pcwu.parseSoftHeader(h, soft)
+        pcwu.validateSoftHeader(h, sh)
+
+    def parseRegistersViewFew():
+        mp = pcwu.parseRegistersView(configData, 302, 226)
+        return mp['TapWaterTemp'], mp['TapWaterHysteresis'], mp['AmbientMinTemp']
+
+    return [
+        ('crc8', lambda: crc8(header)),
+        ('crc16', lambda: crc16(payload)),
+        ('parseHardHeader', lambda: pcwu.parseHardHeader(status)),
+        ('parseHardHeader+validate', lambda: pcwu.validateHardHeader(pcwu.parseHardHeader(status))),
+        ('parseSoftHeader', lambda: pcwu.parseSoftHeader(h, soft)),
+        ('parseSoftHeader+validate', parseSoftHeaderValidate),
+        ('parseRegisters pcwu status', lambda: pcwu.parseRegisters(statusData, 120, 182)),
+        ('parseRegisters pcwu config', lambda: pcwu.parseRegisters(configData, 302, 226)),
+        ('parseRegisters pcwu status unknown', lambda: pcwu.parseRegisters(statusData, 120, 182, True)),
+        ('parseRegisters pcwu config unknown', lambda: pcwu.parseRegisters(configData, 302, 226, True)),
+        ('parseRegistersView pcwu config', lambda: pcwu.parseRegistersView(configData, 302, 226)),
+        ('parseRegistersView pcwu config 3 values', parseRegistersViewFew),
+        ('parseRegistersView pcwu config dict', lambda: dict(pcwu.parseRegistersView(configData, 302, 226))),
+        ('parseRegisters zps status', lambda: zps.parseRegisters(zpsStatusData, 120, 50)),
+        ('parseRegisters zps config', lambda: zps.parseRegisters(zpsConfigData, 170, 76)),
+        ('parseRegisters zps config unknown', lambda: zps.parseRegisters(zpsConfigData, 170, 76, True)),
+        ('processAllMessages pcwu cycle', lambda: pcwu.processAllMessages(cycle)),
+        ('processAllMessages zps all', lambda: zps.processAllMessages(zpsAll)),
+        ('createReadRegistersMessage', lambda: pcwu.createReadRegistersMessage(302, 226)),
+        ('createWriteRegistersMessage', lambda: pcwu.createWriteRegistersMessage(302, 80, values)),
+    ]
+
+def measure(func, minTime=0.2, repeat=5):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * minTime / 0.2))
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+
+    # Allocations; tracemalloc slows everything down so measured separately
+    func()
+    tracemalloc.start()     # Starts with a peak of zero; reset_peak is Python 3.9+
+    before = tracemalloc.get_traced_memory()[0]
+    func()
+    peakBytes = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    return {
+        'opsPerSec': 1 / best,
+        'usPerOp': best * 1e6,
+        'peakBytes': peakBytes,
+    }
+
+def run(names=None, minTime=0.2, repeat=5):
+    results = {}
+    for name, func in setupBenchmarks():
+        if names and not any(n in name for n in names):
+            continue
+        results[name] = measure(func, minTime, repeat)
+    return results
+
+def report(results, baseline=None):
+    print("%-40s %12s %10s %10s %9s" % ('benchmark', 'ops/sec', 'us/op', 'peak B', 'vs base'))
+    for name, r in results.items():
+        change = ''
+        if baseline and name in baseline.get('results', {}):
+            change = "%+8.1f%%" % ((r['opsPerSec'] / baseline['results'][name]['opsPerSec'] - 1) * 100)
+        print("%-40s %12.0f %10.2f %10d %9s" % (name, r['opsPerSec'], r['usPerOp'], r['peakBytes'], change))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Geco protocol microbenchmarks")
+    parser.add_argument('names', nargs='*', help="Only run benchmarks whose name contains one of these")
+    parser.add_argument('--json', help="Save results to this file")
+    parser.add_argument('--baseline', help="Compare results to those saved in this file")
+    parser.add_argument('--min-time', type=float, default=0.2, help="Minimum time per repetition (seconds)")
+    parser.add_argument('--repeat', type=int, default=5, help="Number of repetitions; the best one counts")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = run(args.names, args.min_time, args.repeat)
+    report(results, baseline)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'machine': platform.machine(),
+                'results': results,
+            }, f, indent=2)
+
+if __name__ == '__main__':
+    main()
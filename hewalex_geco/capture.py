@@ -0,0 +1,254 @@
+import struct
+import time
+
+
+# Capture and replay of bus traffic
+#
+# A capture file starts with MAGIC followed by records:
+#
+#   kind (1 byte) | time since previous record in us (varint) | length (varint) | payload
+#
+# Every writer session starts with a SESSION record holding the absolute start
+# time, so captures can simply be appended to. FRAME records hold a complete
+# raw frame; DELTA records hold From, FNC and RegStart (4 bytes) followed by
+# the byte runs in which a frame differs from the previous frame with the same
+# (From, FNC, RegStart), each run as skip and num varints followed by num
+# bytes. Most registers don't change from one cycle to the next, so a status
+# write of about 200 bytes is stored in a dozen or so bytes. RAW records
+# hold bytes as read from the port, which don't need to be frame aligned.
+#
+# Example:
+#
+#   with CaptureWriter('pcwu.cap') as cap:
+#       dev.eavesDrop(CaptureSerial(ser, cap), 10)     # raw serial stream
+#       dev.readStatusRegisters(ser, cap.wrap(onMessage))   # frames only
+#
+#   replay(dev, 'pcwu.cap', speed=10)
+
+MAGIC = b'GECOCAP1'
+
+SESSION = 0
+FRAME = 1
+DELTA = 2
+RAW = 3
+
+MIN_DELTA_FRAME_LEN = 18    # Hard header and soft header up to and including RegStart
+
+
+def encodeVarint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return out
+
+def decodeVarint(buf, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+def frameKey(frame):
+    return bytes((frame[2], frame[12], frame[16], frame[17]))
+
+# Runs of bytes of frame which differ from prev (of the same length)
+def encodeDelta(prev, frame):
+    out = bytearray()
+    pos = 0
+    i = 0
+    n = len(frame)
+    while i < n:
+        if frame[i] == prev[i]:
+            i += 1
+            continue
+        j = i
+        while j < n and frame[j] != prev[j]:
+            j += 1
+        out += encodeVarint(i - pos)
+        out += encodeVarint(j - i)
+        out += frame[i:j]
+        pos = i = j
+    return out
+
+def decodeDelta(prev, delta):
+    frame = bytearray(prev)
+    pos = 0
+    i = 0
+    while i < len(delta):
+        skip, i = decodeVarint(delta, i)
+        num, i = decodeVarint(delta, i)
+        pos += skip
+        frame[pos:pos + num] = delta[i:i + num]
+        pos += num
+        i += num
+    return bytes(frame)
+
+
+class CaptureWriter:
+
+    def __init__(self, f, deltas=True):
+        if isinstance(f, str):
+            f = open(f, 'ab')
+        self.f = f
+        self.deltas = deltas        # Delta compress frames?
+        self.last = None            # Time of previous record
+        self.previous = {}          # (From, FNC, RegStart) => previous frame
+        self.records = 0            # Number of records written
+        self.bytes = 0              # Number of bytes written
+        if f.tell() == 0:
+            f.write(MAGIC)
+            self.bytes += len(MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    def flush(self):
+        self.f.flush()
+
+    def writeRecord(self, kind, payload, t=None):
+        if t is None:
+            t = time.time()
+        if self.last is None:
+            self.last = t
+            self.writeRecord(SESSION, struct.pack('<d', t), t)
+        dt = max(0, round((t - self.last) * 1000000))
+        self.last += dt / 1000000   # Same rounding as the reader, so errors don't add up
+        record = bytearray((kind,))
+        record += encodeVarint(dt)
+        record += encodeVarint(len(payload))
+        record += payload
+        self.f.write(record)
+        self.records += 1
+        self.bytes += len(record)
+
+    def writeFrame(self, frame, t=None):
+        frame = bytes(frame)
+        if self.deltas and len(frame) >= MIN_DELTA_FRAME_LEN:
+            key = frameKey(frame)
+            prev = self.previous.get(key, None)
+            self.previous[key] = frame
+            if prev is not None and len(prev) == len(frame):
+                delta = key + encodeDelta(prev, frame)
+                if len(delta) < len(frame):
+                    self.writeRecord(DELTA, delta, t)
+                    return
+        self.writeRecord(FRAME, frame, t)
+
+    def writeRaw(self, data, t=None):
+        if data:
+            self.writeRecord(RAW, bytes(data), t)
+
+    # Wrap an onMessage handler so all frames passed to it are captured too
+    def wrap(self, onMessage=None):
+        def captureMessage(dev, h, sh, m):
+            self.writeFrame(m)
+            if onMessage:
+                onMessage(dev, h, sh, m)
+        return captureMessage
+
+
+# Serial port wrapper which captures all bytes read from the port
+class CaptureSerial:
+
+    def __init__(self, ser, writer):
+        self.ser = ser
+        self.writer = writer
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    def __setattr__(self, name, value):
+        if name in ('ser', 'writer'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.ser, name, value)
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        self.writer.writeRaw(data)
+        return data
+
+    def read_until(self, *args, **kwargs):
+        data = self.ser.read_until(*args, **kwargs)
+        self.writer.writeRaw(data)
+        return data
+
+
+class CaptureReader:
+
+    def __init__(self, f):
+        if isinstance(f, str):
+            with open(f, 'rb') as fp:
+                f = fp.read()
+        elif not isinstance(f, (bytes, bytearray)):
+            f = f.read()
+        if f[:len(MAGIC)] != MAGIC:
+            raise Exception("Not a capture file")
+        self.buf = f
+
+    # Yield (time, kind, data) for all FRAME and RAW records; DELTA records are
+    # expanded to complete FRAME records
+    def __iter__(self):
+        buf = self.buf
+        pos = len(MAGIC)
+        t = 0.0
+        previous = {}
+        while pos < len(buf):
+            kind = buf[pos]
+            dt, pos = decodeVarint(buf, pos + 1)
+            length, pos = decodeVarint(buf, pos)
+            payload = buf[pos:pos + length]
+            if len(payload) < length:
+                break   # Truncated last record
+            pos += length
+            t += dt / 1000000
+            if kind == SESSION:
+                t = struct.unpack('<d', payload)[0]
+                previous = {}
+                continue
+            if kind == DELTA:
+                prev = previous.get(bytes(payload[:4]), None)
+                if prev is None:
+                    raise Exception("Delta record at offset %d without previous frame" % pos)
+                kind, payload = FRAME, decodeDelta(prev, payload[4:])
+            if kind == FRAME:
+                if len(payload) >= MIN_DELTA_FRAME_LEN:
+                    previous[frameKey(payload)] = payload
+            elif kind != RAW:
+                raise Exception("Unknown record kind %d at offset %d" % (kind, pos))
+            yield t, kind, bytes(payload)
+
+
+# Feed a capture through processAllMessages of dev, at real time (speed=1), N
+# times real time (speed=N) or as fast as possible (speed=None). Returns the
+# number of records replayed.
+def replay(dev, f, speed=None, onMessage=None):
+    reader = f if isinstance(f, CaptureReader) else CaptureReader(f)
+    start = None
+    cnt = 0
+    rest = b''
+    for t, kind, data in reader:
+        if speed:
+            if start is None:
+                start = (t, time.monotonic())
+            delay = start[1] + (t - start[0]) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        if kind == RAW:
+            rest = dev.processAllMessages(rest + data, onMessage=onMessage)
+        else:
+            dev.processAllMessages(data, onMessage=onMessage)
+        cnt += 1
+    return cnt
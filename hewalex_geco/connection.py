@@ -0,0 +1,95 @@
+import socket
+import time
+
+import serial
+
+
+# Persistent connection to a serial port or RS485 to TCP gateway
+#
+# Opening a port for every command costs a TCP handshake (and on serial ports
+# a flush of stale input) each time. A Connection keeps one port open, checks
+# that it is still healthy before handing it out and transparently reconnects
+# when it isn't or when an I/O error occurs while using it.
+
+class Connection:
+
+    def __init__(self, addr, serialParameters=None, metrics=None):
+        self.addr = addr                                # Serial port or socket://host:port
+        self.serialParameters = serialParameters or {}  # Only used for serial ports
+        self.metrics = metrics                          # Metrics to record port open times in
+        if metrics is not None:
+            metrics.addSource('connection', self.stats)
+        self.ser = None
+        self.connects = 0                               # Number of times the port was opened
+        self.reconnects = 0                             # Number of times the port had to be reopened
+        self.failures = 0                               # Number of I/O errors while using the port
+
+    def isSocket(self):
+        return self.addr.startswith("socket://")
+
+    def isOpen(self):
+        return self.ser is not None and self.ser.is_open
+
+    def open(self):
+        start = time.monotonic()
+        if self.isSocket():
+            ser = serial.serial_for_url(self.addr)
+        else:
+            ser = serial.Serial(self.addr, **self.serialParameters)
+        if self.metrics is not None:
+            self.metrics.observe('port_open_seconds', time.monotonic() - start)
+        if self.connects > 0:
+            self.reconnects += 1
+        self.connects += 1
+        self.ser = ser
+        return ser
+
+    def close(self):
+        if self.ser is not None:
+            try:
+                self.ser.close()
+            except Exception:
+                pass
+            self.ser = None
+
+    def isHealthy(self):
+        if not self.isOpen():
+            return False
+        if self.isSocket():
+            # A socket closed by the gateway stays 'open' in pyserial until a read
+            # fails; peek at it to find out without consuming any data
+            sock = getattr(self.ser, '_socket', None)
+            if sock is None:
+                return False
+            try:
+                return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b''
+            except BlockingIOError:
+                return True
+            except OSError:
+                return False
+        return True
+
+    # Get an open and healthy port, (re)connecting if needed
+    def get(self):
+        if not self.isHealthy():
+            self.close()
+            self.open()
+        return self.ser
+
+    # Call func(ser, *args, **kwargs) on the port; on I/O errors reconnect and try once more
+    def call(self, func, *args, **kwargs):
+        for attempt in (1, 2):
+            try:
+                return func(self.get(), *args, **kwargs)
+            except (serial.SerialException, OSError):
+                self.failures += 1
+                self.close()
+                if attempt == 2:
+                    raise
+
+    def stats(self):
+        return {
+            'connects': self.connects,
+            'reconnects': self.reconnects,
+            'failures': self.failures,
+        }
@@ -1,35 +1,112 @@
 # Based on work by krzysztof1111111111
 # https://www.elektroda.pl/rtvforum/topic3499254.html
 
+from binascii import crc_hqx
 
-POLY = 0xD5
-def crc8(buf):
-    if len(buf) == 0:
-        return 0
 
-    accum = 0
-    for i in buf:
-        accum = accum ^ i
+# Table driven implementation of the CRCs used in Geco messages. Both tables
+# are generated once at import time using the original bitwise algorithm, so
+# results are identical to the previous implementation while only a single
+# table lookup per byte is needed. All functions accept bytes, bytearray,
+# memoryview or any other iterable of ints without making a copy.
+
+POLY = 0xD5
+def _crc8Table():
+    table = []
+    for i in range(256):
+        accum = i
         for _ in range(8):
             if accum & 0x80:
                 accum = (((accum << 1) & 0xff) ^ POLY) & 0xff
             else:
                 accum = (accum << 1) & 0xff
+        table.append(accum)
+    return tuple(table)
 
-    return accum
+CRC8_TABLE = _crc8Table()
 
 POLY16 = 0x1021
-def crc16(buf):
-    if len(buf) == 0:
-        return 0
-
-    accum = 0
-    for i in buf:
-        accum = accum ^ (i << 8)
+def _crc16Table():
+    table = []
+    for i in range(256):
+        accum = i << 8
         for _ in range(8):
             if accum & 0x8000:
                 accum = (((accum << 1) & 0xffff) ^ POLY16) & 0xffff
             else:
                 accum = (accum << 1) & 0xffff
+        table.append(accum)
+    return tuple(table)
+
+CRC16_TABLE = _crc16Table()
 
+
+def crc8_update(accum, buf):
+    table = CRC8_TABLE
+    for i in buf:
+        accum = table[accum ^ i]
     return accum
+
+def crc8(buf):
+    return crc8_update(0, buf)
+
+def crc16_update(accum, buf):
+    # CRC16 with polynomial 0x1021 and zero init is CRC-16/XMODEM, which is what
+    # binascii.crc_hqx implements in C; use it for anything bytes-like
+    try:
+        return crc_hqx(buf, accum)
+    except TypeError:
+        pass
+    table = CRC16_TABLE
+    for i in buf:
+        accum = ((accum << 8) & 0xffff) ^ table[(accum >> 8) ^ i]
+    return accum
+
+def crc16(buf):
+    return crc16_update(0, buf)
+
+
+# Streaming variants; feed bytes as they arrive and ask for the digest at the
+# end of the frame, eg.
+#
+#   c = Crc16()
+#   c.update(chunk1)
+#   c.update(chunk2)
+#   c.digest()
+#
+class Crc8:
+    __slots__ = ('value',)
+
+    def __init__(self, buf=None):
+        self.value = 0
+        if buf is not None:
+            self.update(buf)
+
+    def update(self, buf):
+        self.value = crc8_update(self.value, buf)
+        return self
+
+    def digest(self):
+        return self.value
+
+    def reset(self):
+        self.value = 0
+
+
+class Crc16:
+    __slots__ = ('value',)
+
+    def __init__(self, buf=None):
+        self.value = 0
+        if buf is not None:
+            self.update(buf)
+
+    def update(self, buf):
+        self.value = crc16_update(self.value, buf)
+        return self
+
+    def digest(self):
+        return self.value
+
+    def reset(self):
+        self.value = 0
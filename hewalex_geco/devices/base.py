@@ -1,6 +1,14 @@
+import time
 from binascii import hexlify, unhexlify
 
 from ..crc import *
+from ..metrics import Metrics
+from .decode import DecodePlan, RegisterView
+from .registers import RegisterMap
+from .planner import planReads, DEFAULT_BAUDRATE, DEFAULT_TURNAROUND
+from .parser import FrameParser
+from .frame import HardHeader, SoftFrame
+from .shadow import ShadowRegisters, SOURCE_EAVESDROP, SOURCE_READ, SOURCE_WRITE
 
 # Based on work by krzysztof1111111111
 # https://www.elektroda.pl/rtvforum/topic3499254.html
@@ -13,31 +21,43 @@ class BaseDevice:
         self.devHardId = devHardId  # Hewalex device - physical address
         self.devSoftId = devSoftId  # Hewalex device - logical address
         self.onMessage = onMessage  # Callback - onMessage(obj, h, sh, m)
+        self.parser = FrameParser(self)
+        self.lastLatency = None     # Time between sending last request and receiving its response
+        self.numResponses = 0
+        self.totalLatency = 0.0
+        self.maxLatency = 0.0
+        self.shadow = ShadowRegisters()  # Last known raw contents of device registers
+        self.setMetrics(Metrics())
+
+    # Record transaction timings and error counters in metrics, eg. shared with
+    # the Connection used
+    def setMetrics(self, metrics):
+        self.metrics = metrics
+        metrics.addSource('parser', self.parser.stats)
+
+    # Every device class gets its own immutable register map when it is defined
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.registerMap = RegisterMap(cls.registers)
 
     def parseHardHeader(self, m):
         if len(m) < 8:
             raise Exception("Too short message")
-        calcCrc = crc8(m[:7])
-        return {
-            "StartByte": m[0],
-            "To": m[1],
-            "From": m[2],
-            "ConstBytes": (m[5] << 16) | (m[4] << 8) | m[3],
-            "Payload": m[6],
-            "CRC8": m[7],
-            "CalcCRC8": calcCrc
-        }
+        return HardHeader(memoryview(m)[:8])
 
     def validateHardHeader(self, h):
         if h["StartByte"] != 0x69:
             raise Exception("Invalid Start Byte")
         if h["CRC8"] != h["CalcCRC8"]:
+            self.metrics.inc('bad_crc8_total')
             raise Exception("Invalid Hard CRC8")
         if h["ConstBytes"] != 0x84:
             raise Exception("Invalid Const Bytes")
         if h["From"] != self.conHardId and h["From"] != self.devHardId:
+            self.metrics.inc('invalid_address_total')
             raise Exception("Invalid From Hard Address: " + str(h["From"]))
         if h["To"] != self.conHardId and h["To"] != self.devHardId:
+            self.metrics.inc('invalid_address_total')
             raise Exception("Invalid To Hard Address: " + str(h["To"]))
         if h["To"] == h["From"]:
             raise Exception("From and To Hard Address Equal")
@@ -59,27 +79,19 @@ class BaseDevice:
             raise Exception("Invalid soft message len")
         if len(m) < 12:
             raise Exception("Too short soft message")
-        calcCrc = crc16(m[:h["Payload"]-2])
-        return {
-            "To": self.getWord(m[0:]),
-            "From": self.getWord(m[2:]),
-            "FNC": m[4],
-            "ConstByte": self.getWord(m[5:]),
-            "RegLen": m[7],
-            "RegStart": self.getWord(m[8:]),
-            "RestMessage": m[10:h["Payload"]-2],
-            "CRC16": self.getWordReverse(m[h["Payload"]-2:]),
-            "CalcCRC16": calcCrc
-        }
+        return SoftFrame(memoryview(m))
 
     def validateSoftHeader(self, h, sh):
         if sh["CRC16"] != sh["CalcCRC16"]:
+            self.metrics.inc('bad_crc16_total')
             raise Exception("Invalid Soft CRC16")
         if sh["ConstByte"] != 0x80:
             raise Exception("Invalid Const Soft Byte 0x80")
         if (h["From"] == self.conHardId and sh["From"] != self.conSoftId) or (h["From"] == self.devHardId and sh["From"] != self.devSoftId):
+            self.metrics.inc('invalid_address_total')
             raise Exception("Invalid From Address")
         if (h["To"] == self.conHardId and sh["To"] != self.conSoftId) or (h["To"] == self.devHardId and sh["To"] != self.devSoftId):
+            self.metrics.inc('invalid_address_total')
             raise Exception("Invalid To Address")
 
     def getTemp(self, w, divisor):
@@ -95,14 +107,51 @@ class BaseDevice:
             val = val >> 1
 
     def getRegisterByNumber(self, regnum):
-        return self.registers.get(regnum, None)
+        return self.registerMap.getRegisterByNumber(regnum)
 
     def getRegisterByName(self, regname):
-        for regnum, reg in self.registers.items():
-            if reg['name'] == regname:
-                return regnum, reg
+        return self.registerMap.getRegisterByName(regname)
+
+    def resolveRegisterRanges(self, names):
+        return self.registerMap.resolveRanges(names, self.REG_MAX_NUM)
+
+    # Fewest bus time (start, num) reads covering the registers holding names
+    def planReads(self, names, baudrate=DEFAULT_BAUDRATE, turnaround=DEFAULT_TURNAROUND):
+        return planReads(self.registerMap, names, self.REG_MAX_NUM, baudrate, turnaround)
+
+    # Decode plans are compiled once per device class and register window
+    MAX_DECODE_PLANS = 256
+
+    def getDecodePlan(self, regstart, reglen, unknown=False):
+        cls = type(self)
+        plans = cls.__dict__.get('_decodePlans')
+        if plans is None:
+            plans = {}
+            cls._decodePlans = plans
+        key = (regstart, reglen, unknown)
+        plan = plans.get(key)
+        if plan is None:
+            if len(plans) >= self.MAX_DECODE_PLANS:
+                plans.clear()
+            plan = DecodePlan(self.registerMap.byNumber, regstart, reglen, unknown)
+            plans[key] = plan
+        return plan
 
     def parseRegisters(self, m, regstart, reglen, unknown=False):
+        plan = self.getDecodePlan(regstart, reglen, unknown)
+        if plan.matches(m):
+            return plan.decode(m)
+        # Message shorter than the window; let the register walk sort it out
+        return self.parseRegistersWalk(m, regstart, reglen, unknown)
+
+    # Like parseRegisters, but registers are only decoded when accessed
+    def parseRegistersView(self, m, regstart, reglen, unknown=False):
+        plan = self.getDecodePlan(regstart, reglen, unknown)
+        if plan.matches(m):
+            return RegisterView(plan, m)
+        return RegisterView(None, m, self.parseRegistersWalk(m, regstart, reglen, unknown))
+
+    def parseRegistersWalk(self, m, regstart, reglen, unknown=False):
         ret = {}
 
         skip = 0
@@ -191,18 +240,111 @@ class BaseDevice:
             onMessage(self, h, sh, m)
         return m[ml+8:]
 
+    # Remember register contents sent by the device
+    def updateShadow(self, h, sh):
+        if h["From"] == self.devHardId:
+            fnc = sh["FNC"]
+            if fnc == 0x50:
+                self.shadow.update(sh["RegStart"], sh["RestMessage"], SOURCE_READ)
+            elif fnc == 0x60:
+                self.shadow.update(sh["RegStart"], sh["RestMessage"], SOURCE_EAVESDROP)
+
+    def dispatchFrame(self, h, sh, frame, onMessage):
+        self.updateShadow(h, sh)
+        if onMessage:
+            onMessage(self, h, sh, frame)
+
+    def processFrames(self, frames, onMessage=None):
+        if onMessage is None:
+            onMessage = self.onMessage
+        cnt = 0
+        for h, sh, frame in frames:
+            cnt += 1
+            self.dispatchFrame(h, sh, frame, onMessage)
+        return cnt
+
+    # Process all valid messages in m; garbage and invalid messages are skipped and
+    # counted by the frame parser. Returns the bytes of a trailing incomplete message.
     def processAllMessages(self, m, returnRemainingBytes=False, onMessage=None):
-        minLen = 8 if returnRemainingBytes else 0
-        prevLen = len(m)
-        while prevLen > minLen:
-            m = self.processMessage(m, ignoreTooShort=returnRemainingBytes, onMessage=onMessage)
-            if len(m) == prevLen:
-                if returnRemainingBytes:
-                    return m
-                else:
-                    raise Exception("Something wrong")
-            prevLen = len(m)
-        return m
+        self.parser.reset()
+        self.processFrames(self.parser.feed(m), onMessage=onMessage)
+        return self.parser.take()
+
+    # Response timing; a request completes as soon as the complete response frame
+    # from the device is in, with an overall deadline and a maximum silence between
+    # bytes of a partially received frame
+    RESPONSE_TIMEOUT = 0.4
+    INTER_BYTE_TIMEOUT = 0.05
+
+    def isResponse(self, h):
+        return h["From"] == self.devHardId and h["To"] == self.conHardId
+
+    # Send request m and process frames until the response from the device is in;
+    # fail only if something came back but no valid response
+    #
+    # Timings recorded per transaction: write (flush and send the request), first
+    # byte and last byte (from sending until the first byte and the complete
+    # response came in), parse (frame parsing and validation) and callback
+    # (onMessage handlers).
+    def transaction(self, ser, m, onMessage=None):
+        if onMessage is None:
+            onMessage = self.onMessage
+        metrics = self.metrics
+        metrics.inc('transactions_total')
+        self.parser.reset()
+        begin = time.monotonic()
+        ser.flushInput()
+        ser.write(m)
+        start = time.monotonic()
+        metrics.observe('transaction_write_seconds', start - begin)
+        deadline = start + self.RESPONSE_TIMEOUT
+        self.lastLatency = None
+        received = 0
+        parseTime = 0.0
+        callbackTime = 0.0
+        while self.lastLatency is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if self.parser.pending() > 0:
+                remaining = min(remaining, self.INTER_BYTE_TIMEOUT)
+            ser.timeout = remaining
+            r = ser.read(self.parser.needed())
+            if not r:
+                break
+            arrived = time.monotonic()
+            if received == 0:
+                metrics.observe('transaction_first_byte_seconds', arrived - start)
+            received += len(r)
+            for h, sh, frame in self.parser.feed(r):
+                parsed = time.monotonic()
+                self.dispatchFrame(h, sh, frame, onMessage)
+                callbackTime += time.monotonic() - parsed
+                if self.isResponse(h):
+                    self.lastLatency = arrived - start
+                    break
+            parseTime += time.monotonic() - arrived
+        metrics.observe('transaction_parse_seconds', parseTime - callbackTime)
+        metrics.observe('transaction_callback_seconds', callbackTime)
+        if self.lastLatency is None:
+            if received > 0:
+                metrics.inc('invalid_responses_total')
+                raise Exception("No valid response in %d received bytes; %s" % (received, self.parser.lastError or "timeout"))
+            metrics.inc('timeouts_total')
+        else:
+            metrics.observe('transaction_last_byte_seconds', self.lastLatency)
+            self.numResponses += 1
+            self.totalLatency += self.lastLatency
+            self.maxLatency = max(self.maxLatency, self.lastLatency)
+        return self.parser.take()
+
+    def latencyStats(self):
+        return {
+            'last': self.lastLatency,
+            'avg': self.totalLatency / self.numResponses if self.numResponses else None,
+            'max': self.maxLatency,
+            'responses': self.numResponses,
+        }
 
     # Process all messages in X cycles of device to controller comms
     #
@@ -247,28 +389,29 @@ class BaseDevice:
             # process
             self.processAllMessages(s + m, onMessage=onMessage)
 
-    def createReadRegistersMessage(self, start, num):
+    def getRegisterStart(self, start):
         if isinstance(start, str):
             start = self.getRegisterByName(start)[0]
-        header = [0x69, self.devHardId, self.conHardId, 0x84, 0, 0]
-        payload = [(self.devSoftId & 0xff), ((self.devSoftId >> 8) & 0xff), (self.conSoftId & 0xff), ((self.conSoftId >> 8) & 0xff), 0x40, 0x80, 0, num & 0xff, start & 0xff, (start >> 8) & 0xff]
-        calcCrc16 = crc16(payload)
-        payload.append((calcCrc16 >> 8) & 0xff)
-        payload.append(calcCrc16 & 0xff)
-        header.append(len(payload))
-        calcCrc8 = crc8(header)
-        header.append(calcCrc8)
-        return bytearray(header + payload)
+        return start
 
-    def createWriteRegistersMessage(self, start, num, values):
-        if isinstance(start, str):
-            start = self.getRegisterByName(start)[0]
-        header = [0x69, self.devHardId, self.conHardId, 0x84, 0, 0]
-        payload = [(self.devSoftId & 0xff), ((self.devSoftId >> 8) & 0xff), (self.conSoftId & 0xff), ((self.conSoftId >> 8) & 0xff), 0x60, 0x80, 0, num & 0xff, start & 0xff, (start >> 8) & 0xff]
+    def encodeValues(self, values):
+        data = bytearray()
         for val in values:
-            payload.append(val & 0xff)
-            payload.append((val >> 8) & 0xff)
-        calcCrc16 = crc16(payload)
+            data.append(val & 0xff)
+            data.append((val >> 8) & 0xff)
+        return bytes(data)
+
+    # Create a message from controller to device, or from device to controller
+    def createMessage(self, fnc, start, num, data=b'', fromDevice=False):
+        start = self.getRegisterStart(start)
+        if fromDevice:
+            toHardId, fromHardId, toSoftId, fromSoftId = self.conHardId, self.devHardId, self.conSoftId, self.devSoftId
+        else:
+            toHardId, fromHardId, toSoftId, fromSoftId = self.devHardId, self.conHardId, self.devSoftId, self.conSoftId
+        header = [0x69, toHardId, fromHardId, 0x84, 0, 0]
+        payload = [(toSoftId & 0xff), ((toSoftId >> 8) & 0xff), (fromSoftId & 0xff), ((fromSoftId >> 8) & 0xff), fnc, 0x80, 0, num & 0xff, start & 0xff, (start >> 8) & 0xff]
+        payload.extend(data)
+        calcCrc16 = crc16(bytes(payload))
         payload.append((calcCrc16 >> 8) & 0xff)
         payload.append(calcCrc16 & 0xff)
         header.append(len(payload))
@@ -276,46 +419,88 @@ class BaseDevice:
         header.append(calcCrc8)
         return bytearray(header + payload)
 
+    def createReadRegistersMessage(self, start, num):
+        return self.createMessage(0x40, start, num)
+
+    def createWriteRegistersMessage(self, start, num, values):
+        return self.createMessage(0x60, start, num, self.encodeValues(values))
+
     def createWriteRegisterMessage(self, reg, val):
         return self.createWriteRegistersMessage(reg, 2, [val])
 
-    def readRegisters(self, ser, start, num, onMessage=None):
+    # Response of the device to a read request, used to replay cached registers
+    def createReadResponseMessage(self, start, num, data):
+        return self.createMessage(0x50, start, num, data, fromDevice=True)
+
+    # Scale factors to turn a value into the word written to a register
+    REGISTER_SCALES = {
+        'te10': 10,
+        'fl10': 10,
+        'f100': 100,
+    }
+
+    def encodeRegister(self, regname, val):
+        reg = self.getRegisterByName(regname)
+        if reg is None:
+            raise Exception("Unknown register name: " + str(regname))
+        return int(val * self.REGISTER_SCALES.get(reg[1]['type'], 1))
+
+    # Reads can be served from the shadow registers if all of them were updated
+    # less than maxAge seconds ago; the onMessage callback then receives a
+    # response message recreated from the shadow registers
+    def readRegisters(self, ser, start, num, onMessage=None, maxAge=None):
+        start = self.getRegisterStart(start)
+        if maxAge is not None:
+            data = self.shadow.getRange(start, num, maxAge)
+            if data is not None:
+                self.shadow.hits += 1
+                if onMessage is None:
+                    onMessage = self.onMessage
+                if onMessage:
+                    m = bytes(self.createReadResponseMessage(start, num, data))
+                    h = self.parseHardHeader(m)
+                    onMessage(self, h, self.parseSoftHeader(h, memoryview(m)[8:]), memoryview(m))
+                return b''
         m = self.createReadRegistersMessage(start, num)
-        ser.flushInput()
-        ser.timeout = 0.4
-        ser.write(m)
-        r = ser.read(1000)
-        return self.processAllMessages(r, onMessage=onMessage)
+        return self.transaction(ser, m, onMessage=onMessage)
 
-    def readStatusRegisters(self, ser, onMessage=None):
+    def readStatusRegisters(self, ser, onMessage=None, maxAge=None):
         start = self.REG_STATUS_START
-        return self.readRegisters(ser, start, self.REG_CONFIG_START - start, onMessage=onMessage)
+        return self.readRegisters(ser, start, self.REG_CONFIG_START - start, onMessage=onMessage, maxAge=maxAge)
 
-    def readConfigRegisters(self, ser, onMessage=None):
+    def readConfigRegisters(self, ser, onMessage=None, maxAge=None):
         start = self.REG_CONFIG_START
         while start < self.REG_MAX_ADR:
             num = min(self.REG_MAX_ADR + 2 - start, self.REG_MAX_NUM)
-            self.readRegisters(ser, start, num, onMessage=onMessage)
+            self.readRegisters(ser, start, num, onMessage=onMessage, maxAge=maxAge)
             start = start + num
 
-    def readRegister(self, ser, reg, onMessage=None):
-        return self.readRegisters(ser, reg, 2, onMessage=onMessage)
-
-    def writeRegisters(self, ser, start, num, values, onMessage=None):
+    # Read a list of (start, num) ranges, eg. as planned by planReads
+    def readRegisterRanges(self, ser, ranges, onMessage=None, maxAge=None):
+        for start, num in ranges:
+            self.readRegisters(ser, start, num, onMessage=onMessage, maxAge=maxAge)
+
+    def readRegister(self, ser, reg, onMessage=None, maxAge=None):
+        return self.readRegisters(ser, reg, 2, onMessage=onMessage, maxAge=maxAge)
+
+    # Writes are always sent unless maxAge is given: then writing values which
+    # were written less than maxAge seconds ago, and not read or seen on the
+    # bus since, is skipped. The device's own display can change registers
+    # behind the shadow, so maxAge should be no longer than the poll interval.
+    def writeRegisters(self, ser, start, num, values, onMessage=None, maxAge=None):
+        start = self.getRegisterStart(start)
+        data = self.encodeValues(values)[:num]
+        if maxAge is not None and self.shadow.getRange(start, num, maxAge, source=SOURCE_WRITE) == data:
+            self.shadow.skippedWrites += 1
+            return b''
         m = self.createWriteRegistersMessage(start, num, values)
-        ser.flushInput()
-        ser.timeout = 0.4
-        ser.write(m)
-        r = ser.read(1000)
-        return self.processAllMessages(r, onMessage=onMessage)
+        r = self.transaction(ser, m, onMessage=onMessage)
+        if self.lastLatency is not None:
+            self.shadow.update(start, data, SOURCE_WRITE)
+        return r
 
-    def writeRegister(self, ser, reg, val, onMessage=None):
-        m = self.createWriteRegisterMessage(reg, val)
-        ser.flushInput()
-        ser.timeout = 0.4
-        ser.write(m)
-        r = ser.read(1000)
-        return self.processAllMessages(r, onMessage=onMessage)
+    def writeRegister(self, ser, reg, val, onMessage=None, maxAge=None):
+        return self.writeRegisters(ser, reg, 2, [val], onMessage=onMessage, maxAge=maxAge)
 
 
 # Interface private helper functions
@@ -369,3 +554,5 @@ class BaseDevice:
 #        ...
 #
     }
+
+BaseDevice.registerMap = RegisterMap(BaseDevice.registers)
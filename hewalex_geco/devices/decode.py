@@ -0,0 +1,201 @@
+import struct
+from collections.abc import Mapping
+
+
+# Precompiled register decode plans
+#
+# Decoding a block of registers used to walk the block two bytes at a time,
+# looking up every register and dispatching on its type. A decode plan does
+# all of that once for a given register table and (RegStart, RegLen) window;
+# it translates the window into a single struct format with pad bytes for
+# skipped/unknown registers plus a list of (name, converter) pairs. Decoding
+# a message is then one struct.unpack_from call followed by the conversions.
+#
+# Output is identical to the original register walk, including register types
+# which consume two register slots (date, time, dwrd, tprg) and the byte/word
+# handling of unknown registers.
+#
+# When only a few registers of a block are needed, a RegisterView decodes
+# lazily instead: it keeps the message and decodes a register on first access
+# using the offset and format the plan recorded for it.
+
+def _date(b):
+    return "20{:02d}-{:02d}-{:02d}".format(b[0], b[1], b[2])
+
+def _time(b):
+    return "{:02d}:{:02d}:{:02d}".format(b[0], b[1], b[2])
+
+def _rwrd(v):
+    return ((v & 0xff) << 8) | (v >> 8)
+
+def _temp(v):
+    return v / 1.0
+
+def _div10(v):
+    return v / 10.0
+
+def _f100(v):
+    return v / 100.0
+
+def _tprg(v):
+    return {i: bool((v >> i) & 1) for i in range(24)}
+
+def _none(v):
+    return None
+
+# Register type => (struct format, converter, number of register slots to skip)
+REGISTER_TYPES = {
+    'date': ('3s', _date, 1),
+    'time': ('3s', _time, 1),
+    'word': ('H', int, 0),
+    'rwrd': ('H', _rwrd, 0),
+    'dwrd': ('I', int, 1),
+    'temp': ('h', _temp, 0),
+    'te10': ('h', _div10, 0),
+    'fl10': ('H', _div10, 0),
+    'f100': ('H', _f100, 0),
+    'bool': ('H', bool, 0),
+    'mask': ('H', None, 0),
+    'tprg': ('I', _tprg, 1),
+}
+
+# Unsupported register types decode to None, like they always did
+UNSUPPORTED_TYPE = ('0s', _none, 0)
+
+
+_fieldStructs = {}
+
+def fieldStruct(code):
+    s = _fieldStructs.get(code)
+    if s is None:
+        s = struct.Struct('<' + code)
+        _fieldStructs[code] = s
+    return s
+
+
+class DecodePlan:
+    __slots__ = ('regstart', 'reglen', 'unknown', 'struct', 'ops', 'size', 'exact', 'fields', 'names')
+
+    def __init__(self, registers, regstart, reglen, unknown=False):
+        self.regstart = regstart
+        self.reglen = reglen
+        self.unknown = unknown
+        self.exact = False  # Plan only valid if message length equals size
+
+        fmt = ['<']
+        ops = []
+        fields = {}         # Name => (offset, struct, converter, bit) for lazy decoding
+        pos = 0
+        skip = 0
+        for regnum in range(regstart, regstart + reglen, 2):
+            if skip > 0:
+                skip = skip - 1
+                continue
+            reg = registers.get(regnum, None)
+            adr = regnum - regstart
+            if reg:
+                code, conv, skip = REGISTER_TYPES.get(reg['type'], UNSUPPORTED_TYPE)
+                if conv is None:
+                    name = tuple((bit, bitname) for bit, bitname in enumerate(reg['name']) if bitname is not None)
+                else:
+                    name = reg['name']
+            elif unknown:
+                name = "Reg%d" % regnum
+                if adr + 1 < reglen:
+                    code, conv = 'H', int
+                else:
+                    # Odd trailing byte; decoded as byte only if message ends here
+                    code, conv = 'B', int
+                    self.exact = True
+            else:
+                continue
+            if adr > pos:
+                fmt.append('%dx' % (adr - pos))
+            fmt.append(code)
+            ops.append((name, conv))
+            field = fieldStruct(code)
+            if conv is None:
+                for bit, bitname in name:
+                    fields[bitname] = (adr, field, None, bit)
+            else:
+                fields[name] = (adr, field, conv, None)
+            pos = adr + field.size
+
+        self.struct = struct.Struct(''.join(fmt))
+        self.ops = tuple(ops)
+        self.size = self.struct.size
+        self.fields = fields
+        self.names = tuple(fields)
+
+    def matches(self, m):
+        if self.exact:
+            return len(m) == self.size
+        return len(m) >= self.size
+
+    def decode(self, m, ret=None):
+        if ret is None:
+            ret = {}
+        vals = self.struct.unpack_from(m)
+        for (name, conv), val in zip(self.ops, vals):
+            if conv is None:
+                for bit, bitname in name:
+                    ret[bitname] = bool((val >> bit) & 1)
+            else:
+                ret[name] = conv(val)
+        return ret
+
+
+# Read only mapping of register name => value over a message, decoding each
+# register on first access. Iteration, len, `in` and dict(view) behave like the
+# dict returned by DecodePlan.decode. Without a plan the view wraps values that
+# were decoded already (eg. by the register walk for short messages).
+class RegisterView(Mapping):
+    __slots__ = ('plan', 'm', 'values', 'complete')
+
+    def __init__(self, plan, m, values=None):
+        self.plan = plan
+        self.m = m
+        self.values = {} if values is None else values     # Memoized values
+        self.complete = plan is None                        # All values decoded, in order?
+
+    def __getitem__(self, name):
+        try:
+            return self.values[name]
+        except KeyError:
+            if self.plan is None:
+                raise
+        adr, field, conv, bit = self.plan.fields[name]
+        val = field.unpack_from(self.m, adr)[0]
+        if conv is None:
+            val = bool((val >> bit) & 1)
+        else:
+            val = conv(val)
+        self.values[name] = val
+        return val
+
+    def __contains__(self, name):
+        if self.plan is None:
+            return name in self.values
+        return name in self.plan.fields
+
+    def __iter__(self):
+        if self.plan is None:
+            return iter(self.values)
+        return iter(self.plan.names)
+
+    def __len__(self):
+        if self.plan is None:
+            return len(self.values)
+        return len(self.plan.names)
+
+    # Decode all registers at once; returns the dict parseRegisters would
+    def decodeAll(self):
+        if not self.complete:
+            values = self.plan.decode(self.m)
+            values.update(self.values)
+            self.values = values
+            self.complete = True
+        return self.values
+
+    def __repr__(self):
+        return "RegisterView(%r)" % dict(self)
@@ -0,0 +1,137 @@
+from collections.abc import Mapping
+
+from ..crc import crc8, crc16
+
+
+# Compact frame header types
+#
+# Instead of building a dict per header, these keep a memoryview on the bytes
+# the frame was received in and decode fields only when they are accessed. The
+# soft message body (RestMessage) is a view as well, so no bytes are copied
+# for a frame. Both types behave like a read-only dict, so existing callbacks
+# using h["Payload"] or sh["FNC"] keep working; attribute access (sh.FNC) is
+# the faster alternative.
+
+class HardHeader(Mapping):
+    __slots__ = ('_m',)
+
+    KEYS = ('StartByte', 'To', 'From', 'ConstBytes', 'Payload', 'CRC8', 'CalcCRC8')
+
+    def __init__(self, m):
+        self._m = m
+
+    @property
+    def StartByte(self):
+        return self._m[0]
+
+    @property
+    def To(self):
+        return self._m[1]
+
+    @property
+    def From(self):
+        return self._m[2]
+
+    @property
+    def ConstBytes(self):
+        m = self._m
+        return (m[5] << 16) | (m[4] << 8) | m[3]
+
+    @property
+    def Payload(self):
+        return self._m[6]
+
+    @property
+    def CRC8(self):
+        return self._m[7]
+
+    @property
+    def CalcCRC8(self):
+        return crc8(self._m[:7])
+
+    def raw(self):
+        return self._m
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __repr__(self):
+        return "HardHeader(%r)" % dict(self)
+
+
+class SoftFrame(Mapping):
+    __slots__ = ('_m', '_crc')
+
+    KEYS = ('To', 'From', 'FNC', 'ConstByte', 'RegLen', 'RegStart', 'RestMessage', 'CRC16', 'CalcCRC16')
+
+    def __init__(self, m):
+        self._m = m         # Soft message, starting right after the hard header
+        self._crc = None    # Calculated CRC16, memoized
+
+    @property
+    def To(self):
+        m = self._m
+        return (m[1] << 8) | m[0]
+
+    @property
+    def From(self):
+        m = self._m
+        return (m[3] << 8) | m[2]
+
+    @property
+    def FNC(self):
+        return self._m[4]
+
+    @property
+    def ConstByte(self):
+        m = self._m
+        return (m[6] << 8) | m[5]
+
+    @property
+    def RegLen(self):
+        return self._m[7]
+
+    @property
+    def RegStart(self):
+        m = self._m
+        return (m[9] << 8) | m[8]
+
+    @property
+    def RestMessage(self):
+        return self._m[10:-2]
+
+    @property
+    def CRC16(self):
+        m = self._m
+        return (m[-2] << 8) | m[-1]
+
+    @property
+    def CalcCRC16(self):
+        if self._crc is None:
+            self._crc = crc16(self._m[:-2])
+        return self._crc
+
+    def raw(self):
+        return self._m
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __repr__(self):
+        return "SoftFrame(%r)" % dict(self)
@@ -0,0 +1,122 @@
+# Incremental, resynchronizing Geco frame parser
+#
+# Bytes are fed in chunks as they arrive from the bus. The parser is a small
+# state machine which looks for the 0x69 start byte, waits for a complete hard
+# header, validates it, waits for the complete soft message and validates that
+# too. Only frames which pass all validations of the device are yielded.
+# Garbage and invalid frames are counted and skipped by resynchronizing on the
+# next start byte instead of raising, so one corrupted frame doesn't cost all
+# other frames in a window.
+#
+# The receive buffer is immutable; yielded frames are memoryviews into it and
+# stay valid for as long as they are referenced. A chunk is only copied when an
+# incomplete frame from the previous chunk has to be prepended to it.
+
+START_BYTE = 0x69
+HARD_HEADER_LEN = 8
+
+
+class FrameParser:
+
+    def __init__(self, dev):
+        self.dev = dev              # Device used to parse and validate frames
+        self.buf = b''              # Receive buffer
+        self.pos = 0                # Start of unparsed bytes in receive buffer
+        self.frames = 0             # Number of valid frames yielded
+        self.badFrames = 0          # Number of frames with valid hard header but invalid soft message
+        self.droppedBytes = 0       # Number of bytes skipped while looking for a valid frame
+        self.resyncs = 0            # Number of times synchronization with the frame stream was lost
+        self.synced = True          # Was the last thing seen a valid frame?
+        self.lastError = None       # Last validation error encountered
+
+    def reset(self):
+        self.buf = b''
+        self.pos = 0
+        self.lastError = None
+
+    def pending(self):
+        return len(self.buf) - self.pos
+
+    # Number of bytes still needed to complete the frame at the head of the buffer
+    def needed(self):
+        buf = self.buf
+        start = buf.find(START_BYTE, self.pos)
+        if start < 0:
+            return HARD_HEADER_LEN
+        have = len(buf) - start
+        if have < HARD_HEADER_LEN:
+            return HARD_HEADER_LEN - have
+        return max(1, HARD_HEADER_LEN + buf[start + 6] - have)
+
+    # Remove and return all bytes which have not been parsed (yet)
+    def take(self):
+        rest = self.buf[self.pos:]
+        self.reset()
+        return rest
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'badFrames': self.badFrames,
+            'droppedBytes': self.droppedBytes,
+            'resyncs': self.resyncs,
+        }
+
+    def feed(self, data):
+        if data:
+            if self.pos < len(self.buf):
+                self.buf = self.buf[self.pos:] + data
+            else:
+                self.buf = bytes(data)
+            self.pos = 0
+        return self.parse()
+
+    def _drop(self, num):
+        if self.synced:
+            self.synced = False
+            self.resyncs += 1
+        self.droppedBytes += num
+        self.pos += num
+
+    def parse(self):
+        buf = self.buf
+        view = memoryview(buf)
+        dev = self.dev
+        while True:
+            # Look for start byte
+            start = buf.find(START_BYTE, self.pos)
+            if start < 0:
+                if len(buf) > self.pos:
+                    self._drop(len(buf) - self.pos)
+                break
+            if start > self.pos:
+                self._drop(start - self.pos)
+
+            # Wait for and validate hard header
+            if len(buf) - start < HARD_HEADER_LEN:
+                break
+            try:
+                h = dev.parseHardHeader(view[start:start + HARD_HEADER_LEN])
+                dev.validateHardHeader(h)
+            except Exception as e:
+                self.lastError = e
+                self._drop(1)
+                continue
+
+            # Wait for and validate soft message
+            end = start + HARD_HEADER_LEN + h["Payload"]
+            if len(buf) < end:
+                break
+            try:
+                sh = dev.parseSoftHeader(h, view[start + HARD_HEADER_LEN:end])
+                dev.validateSoftHeader(h, sh)
+            except Exception as e:
+                self.lastError = e
+                self.badFrames += 1
+                self._drop(1)
+                continue
+
+            self.pos = end
+            self.frames += 1
+            self.synced = True
+            yield h, sh, view[start:end]
@@ -0,0 +1,75 @@
+from .registers import registerSize
+
+
+# Demand driven read planner
+#
+# Reading whole status and config blocks transfers hundreds of bytes of which a
+# consumer often only uses a few dozen. Given the registers that are needed,
+# the planner picks the set of (start, num) reads with the lowest total bus
+# time. Every read costs a fixed overhead (request frame, frame overhead of the
+# response and the device turnaround) plus the time to transfer its payload, so
+# reading across a small gap of unneeded registers is cheaper than a separate
+# frame, while a large gap is better skipped. The optimum is found by dynamic
+# programming over the sorted registers, honouring the REG_MAX_NUM limit.
+
+BITS_PER_BYTE = 10          # Start bit, 8 data bits and stop bit
+FRAME_OVERHEAD = 20         # Bytes of a frame without payload: hard header (8), soft header and CRC16 (12)
+
+DEFAULT_BAUDRATE = 38400
+DEFAULT_TURNAROUND = 0.01   # Time the device takes to start responding (seconds)
+
+
+def byteTime(baudrate):
+    return BITS_PER_BYTE / baudrate
+
+# Bus time of one read request, response included, of num bytes
+def readTime(num, baudrate=DEFAULT_BAUDRATE, turnaround=DEFAULT_TURNAROUND):
+    return (2 * FRAME_OVERHEAD + num) * byteTime(baudrate) + turnaround
+
+# Sorted, non overlapping (start, end) byte spans of the registers holding names
+def registerSpans(registerMap, names):
+    spans = []
+    for start, end in sorted(set(
+        (regnum, regnum + registerSize(registerMap.getRegisterByNumber(regnum)))
+        for regnum in (registerMap.getRegisterNumber(name) for name in names)
+    )):
+        if spans and start < spans[-1][1]:
+            spans[-1] = (spans[-1][0], max(end, spans[-1][1]))
+        else:
+            spans.append((start, end))
+    return spans
+
+# Cheapest list of (start, num) reads covering all registers holding names
+def planReads(registerMap, names, maxNum=None, baudrate=DEFAULT_BAUDRATE, turnaround=DEFAULT_TURNAROUND):
+    spans = registerSpans(registerMap, names)
+    frameCost = readTime(0, baudrate, turnaround)
+    perByte = byteTime(baudrate)
+
+    # best[j] = (cost, i) of the cheapest plan for spans[:j] whose last read
+    # covers spans[i:j]
+    best = [(0.0, 0)]
+    for j in range(1, len(spans) + 1):
+        end = spans[j - 1][1]
+        bestCost, bestStart = None, None
+        for i in range(j - 1, -1, -1):
+            num = end - spans[i][0]
+            if maxNum is not None and num > maxNum and i < j - 1:
+                break
+            cost = best[i][0] + frameCost + num * perByte
+            if bestCost is None or cost < bestCost:
+                bestCost, bestStart = cost, i
+        best.append((bestCost, bestStart))
+
+    reads = []
+    j = len(spans)
+    while j > 0:
+        i = best[j][1]
+        start = spans[i][0]
+        reads.append((start, spans[j - 1][1] - start))
+        j = i
+    reads.reverse()
+    return reads
+
+# Total bus time of a list of (start, num) reads
+def planTime(reads, baudrate=DEFAULT_BAUDRATE, turnaround=DEFAULT_TURNAROUND):
+    return sum(readTime(num, baudrate, turnaround) for start, num in reads)
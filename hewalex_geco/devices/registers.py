@@ -0,0 +1,96 @@
+from types import MappingProxyType
+
+
+# Indexed, immutable view on the register table of a device class
+#
+# Built once per device class when the class is defined (see BaseDevice) and
+# shared by all instances. Registers can be looked up by number, by name and,
+# for mask registers, by the name of a single bit.
+
+# Number of bytes occupied by each register type
+REGISTER_SIZES = {
+    'date': 4,
+    'time': 4,
+    'dwrd': 4,
+    'tprg': 4,
+}
+
+def registerSize(reg):
+    return REGISTER_SIZES.get(reg['type'], 2)
+
+
+class RegisterMap:
+    __slots__ = ('byNumber', 'byName', 'bits', '_frozen')
+
+    def __init__(self, registers):
+        byNumber = {}
+        byName = {}
+        bits = {}
+        for regnum in sorted(registers):
+            reg = dict(registers[regnum])
+            if reg['type'] == 'mask':
+                reg['name'] = tuple(reg['name'])
+                for bit, bitname in enumerate(reg['name']):
+                    if bitname is not None:
+                        bits[bitname] = (regnum, bit)
+                reg = MappingProxyType(reg)
+            else:
+                reg = MappingProxyType(reg)
+                byName[reg['name']] = (regnum, reg)
+            byNumber[regnum] = reg
+        self.byNumber = MappingProxyType(byNumber)
+        self.byName = MappingProxyType(byName)
+        self.bits = MappingProxyType(bits)
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError("RegisterMap is immutable")
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        raise AttributeError("RegisterMap is immutable")
+
+    def __len__(self):
+        return len(self.byNumber)
+
+    def __iter__(self):
+        return iter(self.byNumber)
+
+    def __contains__(self, regnum):
+        return regnum in self.byNumber
+
+    def getRegisterByNumber(self, regnum):
+        return self.byNumber.get(regnum, None)
+
+    def getRegisterByName(self, regname):
+        return self.byName.get(regname, None)
+
+    def getBitByName(self, bitname):
+        return self.bits.get(bitname, None)
+
+    # Register number holding a register or mask bit name
+    def getRegisterNumber(self, name):
+        if name in self.byName:
+            return self.byName[name][0]
+        if name in self.bits:
+            return self.bits[name][0]
+        raise Exception("Unknown register name: " + str(name))
+
+    # Resolve a list of register and/or mask bit names to sorted, contiguous
+    # (start, num) ranges ready to be read; num is in bytes like readRegisters.
+    # Ranges are split such that they never exceed maxNum bytes.
+    def resolveRanges(self, names, maxNum=None):
+        spans = sorted(set(
+            (regnum, regnum + registerSize(self.byNumber[regnum]))
+            for regnum in (self.getRegisterNumber(name) for name in names)
+        ))
+        ranges = []
+        for start, end in spans:
+            if ranges:
+                prevStart, prevEnd = ranges[-1]
+                if start <= prevEnd and (maxNum is None or max(end, prevEnd) - prevStart <= maxNum):
+                    ranges[-1] = (prevStart, max(end, prevEnd))
+                    continue
+            ranges.append((start, end))
+        return [(start, end - start) for start, end in ranges]
@@ -0,0 +1,80 @@
+import time
+
+
+# Shadow register store
+#
+# Remembers the raw contents of every device register seen on the bus, with the
+# time it was last updated and where the value came from. Registers are keyed by
+# register number and hold the raw bytes of the register (normally 2, only the
+# last register of an odd length block holds 1).
+
+SOURCE_EAVESDROP = 'eavesdrop'  # Device writing its registers to the controller
+SOURCE_READ = 'read'            # Device responding to a read request
+SOURCE_WRITE = 'write'          # Write request acknowledged by the device
+
+
+class ShadowRegisters:
+
+    def __init__(self):
+        self.registers = {}     # Register number => (raw bytes, timestamp, source)
+        self.hits = 0           # Number of reads served from the shadow
+        self.skippedWrites = 0  # Number of writes skipped because the value was already there
+
+    def clear(self):
+        self.registers.clear()
+
+    def update(self, regstart, data, source, now=None):
+        if now is None:
+            now = time.time()
+        registers = self.registers
+        data = bytes(data)
+        for adr in range(0, len(data), 2):
+            registers[regstart + adr] = (data[adr:adr+2], now, source)
+
+    def get(self, regnum):
+        return self.registers.get(regnum, None)
+
+    def getWord(self, regnum, maxAge=None, now=None):
+        entry = self.getFresh(regnum, maxAge, now)
+        if entry is None or len(entry[0]) < 2:
+            return None
+        return (entry[0][1] << 8) | entry[0][0]
+
+    def getFresh(self, regnum, maxAge=None, now=None, source=None):
+        entry = self.registers.get(regnum, None)
+        if entry is None:
+            return None
+        if source is not None and entry[2] != source:
+            return None
+        if maxAge is not None:
+            if now is None:
+                now = time.time()
+            if now - entry[1] > maxAge:
+                return None
+        return entry
+
+    # Raw bytes of registers start .. start + num if all are known and fresh
+    # (and came from source, if given)
+    def getRange(self, start, num, maxAge=None, now=None, source=None):
+        if now is None:
+            now = time.time()
+        parts = []
+        for regnum in range(start, start + num, 2):
+            entry = self.getFresh(regnum, maxAge, now, source)
+            if entry is None:
+                return None
+            parts.append(entry[0])
+        data = b''.join(parts)
+        if len(data) < num:
+            return None
+        return data[:num]
+
+    # Oldest timestamp of registers start .. start + num; None if any is unknown
+    def getTimestamp(self, start, num):
+        timestamps = []
+        for regnum in range(start, start + num, 2):
+            entry = self.registers.get(regnum, None)
+            if entry is None:
+                return None
+            timestamps.append(entry[1])
+        return min(timestamps) if timestamps else None
@@ -0,0 +1,28 @@
+import asyncio
+
+
+# Reading a PCWU and a ZPS on two gateways from one process example
+from hewalex_geco import aio
+from hewalex_geco.devices import PCWU, ZPS
+
+# onMessage handler
+def onMessage(obj, h, sh, m):
+    if sh["FNC"] == 0x50:
+        #obj.printMessage(h, sh)
+        mp = obj.parseRegisters(sh["RestMessage"], sh["RegStart"], sh["RegLen"])
+        print(type(obj).__name__, mp)
+
+async def main():
+    pcwuConn = await aio.openConnection('socket://192.168.12.34:8899')
+    zpsConn = await aio.openConnection('socket://192.168.12.35:8899')
+    #zpsConn = await aio.openConnection('/dev/ttySC1', { 'baudrate': 38400 })
+    pcwu = PCWU(1, 1, 2, 2, onMessage)
+    zps = ZPS(1, 1, 2, 2, onMessage)
+    await asyncio.gather(
+        aio.readStatusRegisters(pcwu, pcwuConn),
+        aio.readStatusRegisters(zps, zpsConn),
+    )
+    pcwuConn.close()
+    zpsConn.close()
+
+asyncio.run(main())
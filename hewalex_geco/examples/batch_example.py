@@ -0,0 +1,16 @@
+import numpy as np
+
+
+# Decoding a capture of PCWU bus traffic into columns example (needs numpy)
+from hewalex_geco.batch import decodeCapture
+from hewalex_geco.devices import PCWU
+
+dev = PCWU(1, 1, 2, 2)
+
+# Status registers as written by the heat pump every cycle, captured with
+# CaptureWriter (see capture_example.py)
+times, cols = decodeCapture(dev, 'pcwu.cap')[(0x60, dev.REG_STATUS_START, dev.REG_CONFIG_START - dev.REG_STATUS_START)]
+
+print("%d samples from %s to %s" % (len(times), np.datetime64(int(times[0]), 's'), np.datetime64(int(times[-1]), 's')))
+print("T1 (ambient) min %.1f, mean %.1f, max %.1f" % (cols['T1'].min(), cols['T1'].mean(), cols['T1'].max()))
+print("Compressor on %.1f%% of the time" % (cols['CompressorON'].mean() * 100))
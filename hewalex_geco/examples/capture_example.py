@@ -0,0 +1,23 @@
+import serial
+
+
+# Capturing PCWU bus traffic and replaying it example
+from hewalex_geco.capture import CaptureWriter, CaptureSerial, replay
+from hewalex_geco.devices import PCWU
+
+# onMessage handler
+def onMessage(obj, h, sh, m):
+    if sh["FNC"] == 0x60:
+        mp = obj.parseRegisters(sh["RestMessage"], sh["RegStart"], sh["RegLen"])
+        print(mp)
+
+dev = PCWU(1, 1, 2, 2, onMessage)
+
+# Record the raw bus stream of 100 cycles
+ser = serial.serial_for_url('socket://192.168.12.34:8899')
+with CaptureWriter('pcwu.cap') as cap:
+    dev.eavesDrop(CaptureSerial(ser, cap), 100)
+ser.close()
+
+# Replay it at 10x real time
+replay(dev, 'pcwu.cap', speed=10)
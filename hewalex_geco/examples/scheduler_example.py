@@ -0,0 +1,26 @@
+# Polling a PCWU and a ZPS on one RS485 line example
+from hewalex_geco.connection import Connection
+from hewalex_geco.devices import PCWU, ZPS
+from hewalex_geco.scheduler import BusScheduler
+
+# onMessage handler
+def onMessage(obj, h, sh, m):
+    if sh["FNC"] == 0x50:
+        mp = obj.parseRegisters(sh["RestMessage"], sh["RegStart"], sh["RegLen"])
+        print(type(obj).__name__, mp)
+
+# onError handler
+def onError(obj, command, e):
+    print(type(obj).__name__, command, "failed:", e)
+
+pcwu = PCWU(1, 1, 2, 2, onMessage)
+zps = ZPS(1, 1, 3, 3, onMessage)
+
+sched = BusScheduler(Connection('socket://192.168.12.34:8899'), onError)
+sched.addDevice(pcwu, interval=60)
+sched.addDevice(zps, interval=30, weight=2)
+sched.submit(pcwu, 'writeRegister', 'TapWaterTemp', 500)
+try:
+    sched.run()
+except KeyboardInterrupt:
+    sched.connection.close()
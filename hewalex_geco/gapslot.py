@@ -0,0 +1,178 @@
+import collections
+import time
+
+from .devices.planner import readTime
+from .devices.shadow import SOURCE_WRITE
+from .sniffer import CycleSniffer
+
+
+# Bus timing aware request injection
+#
+# While the controller is active it exchanges frames with the device for about
+# 140ms every 500ms. A request sent in the middle of that collides with it and
+# both get lost to CRC errors. The injector watches the live cycle through a
+# CycleSniffer, learns how long the exchange takes and how often it repeats and
+# only sends queued requests when the complete transaction (request, device
+# turnaround and response) fits in the predicted gap before the next cycle.
+# When there is no cycle at all (controller off) requests are sent right away.
+# The port is never flushed: the response is read through the sniffer, like
+# the controller traffic around it, so the sniffer keeps its lock.
+#
+# The sniffer needs the hard/soft ids of the real controller; pass busDev when
+# requests are sent with other controller ids than the ones on the bus.
+#
+# Example:
+#
+#   injector = GapInjector(PCWU(1, 1, 2, 2, onMessage))
+#   injector.submitRead(302, 226)
+#   injector.submitWrite('TapWaterTemp', 2, [500])
+#   injector.run(ser, stop=lambda: not injector.pending())
+#
+
+
+class GapInjector:
+
+    def __init__(self, dev, busDev=None, baudrate=38400, guard=0.02, idleTime=1.0, maxAttempts=2, onError=None):
+        self.dev = dev
+        self.baudrate = baudrate
+        self.guard = guard                  # Margin kept before and after the cycle (seconds)
+        self.idleTime = idleTime            # Silence after which the bus is considered free (seconds)
+        self.maxAttempts = maxAttempts      # Attempts per request before it is given up
+        self.onError = onError              # Called as onError(dev, fnc, start, exception)
+        self.sniffer = CycleSniffer(busDev or dev, onCycle=self.onCycle, onFrame=self.onFrame)
+        self.queue = collections.deque()    # (fnc, start, num, values, onMessage, attempt)
+        self.period = 0.5                   # Learned time between the start of two cycles
+        self.busy = 0.14                    # Learned duration of the exchange of a cycle
+        self.turnaround = 0.05              # Learned time the device takes to respond
+        self.learnRate = 0.2                # Weight of a new observation
+        self.lastStart = None               # Time last cycle started
+        self.listenStart = None             # Time we started listening to the bus
+        self.request = None                 # (response FNC, start, onMessage, time sent, request frame) awaiting its response
+        self.otherFrames = 0                # Frames of others received while awaiting the response
+        self.latency = None                 # Time from sending the request until its response was in
+        self.injected = 0                   # Number of requests sent
+        self.failures = 0                   # Number of requests without valid response
+
+    def learn(self, old, new):
+        return old + self.learnRate * (new - old)
+
+    def onCycle(self, sniffer, cycle):
+        if self.lastStart is not None:
+            period = cycle.start - self.lastStart
+            # A cycle lost in between would teach a period twice as long
+            if 0.5 * self.period < period < 1.5 * self.period:
+                self.period = self.learn(self.period, period)
+        self.lastStart = cycle.start
+        self.busy = self.learn(self.busy, cycle.end - cycle.start)
+
+    def submitRead(self, start, num, onMessage=None):
+        self.queue.append((0x40, self.dev.getRegisterStart(start), num, None, onMessage, 1))
+
+    def submitWrite(self, start, num, values, onMessage=None):
+        self.queue.append((0x60, self.dev.getRegisterStart(start), num, values, onMessage, 1))
+
+    def pending(self):
+        return len(self.queue)
+
+    # Expected time from sending the request until the response is in
+    def transactionTime(self, num):
+        return readTime(num, self.baudrate, self.turnaround)
+
+    # Predicted (start, end) of the gap we are in or the next one; None if the
+    # bus is free regardless of timing
+    def predictGap(self, now):
+        sniffer = self.sniffer
+        if not sniffer.locked:
+            quietSince = sniffer.lastByte if sniffer.lastByte is not None else self.listenStart
+            if now - quietSince >= self.idleTime:
+                return None
+            return (quietSince + self.idleTime, quietSince + self.idleTime)   # Not sure yet; wait
+        start = self.lastStart
+        while start + self.period <= now:
+            start += self.period
+        return (start + self.busy + self.guard, start + self.period - self.guard)
+
+    def canSend(self, now, duration):
+        if self.sniffer.cycle is not None:
+            return False    # Cycle in progress
+        gap = self.predictGap(now)
+        if gap is None:
+            return True
+        return gap[0] <= now and now + duration <= gap[1]
+
+    # Take the response to the request sent out of the frames the sniffer receives
+    def onFrame(self, sniffer, h, sh, frame, now):
+        request = self.request
+        if request is None:
+            return False
+        if bytes(frame) == request[4]:
+            return True     # Echo of the request
+        if not self.dev.isResponse(h) or sh["FNC"] != request[0] or sh["RegStart"] != request[1]:
+            self.otherFrames += 1
+            return False
+        self.request = None
+        self.latency = now - request[3]
+        onMessage = request[2] if request[2] is not None else self.dev.onMessage
+        self.dev.dispatchFrame(h, sh, frame, onMessage)
+        return True
+
+    def execute(self, ser, item, pollTime=0.005):
+        fnc, start, num, values, onMessage, attempt = item
+        dev = self.dev
+        self.injected += 1
+        if fnc == 0x40:
+            m = dev.createReadRegistersMessage(start, num)
+        else:
+            m = dev.createWriteRegistersMessage(start, num, values)
+        sniffer = self.sniffer
+        quietSince = sniffer.lastByte
+        dropped = sniffer.parser.droppedBytes
+        self.latency = None
+        self.otherFrames = 0
+        try:
+            ser.write(m)
+            sent = time.monotonic()
+            self.request = (fnc + 0x10, start, onMessage, sent, bytes(m))
+            deadline = sent + dev.RESPONSE_TIMEOUT
+            while self.latency is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Exception("No response from device")
+                ser.timeout = min(remaining, pollTime)
+                sniffer.feed(ser.read(ser.in_waiting or 1))
+        except Exception as e:
+            self.request = None
+            self.failures += 1
+            if attempt < self.maxAttempts:
+                self.queue.appendleft((fnc, start, num, values, onMessage, attempt + 1))
+            elif self.onError:
+                self.onError(dev, fnc, start, e)
+            return
+        if not self.otherFrames and sniffer.parser.droppedBytes == dropped:
+            sniffer.lastByte = quietSince   # Only our own transaction was on the bus
+        if fnc == 0x60:
+            dev.shadow.update(start, dev.encodeValues(values)[:num], SOURCE_WRITE)
+        self.turnaround = self.learn(self.turnaround, max(0.0, self.latency - readTime(num, self.baudrate, 0)))
+
+    # Sniff the bus and send queued requests in the gaps until stop() returns True
+    def run(self, ser, stop=None, pollTime=0.005):
+        sniffer = self.sniffer
+        if self.listenStart is None:
+            self.listenStart = time.monotonic()
+        while stop is None or not stop():
+            ser.timeout = pollTime
+            sniffer.feed(ser.read(ser.in_waiting or 1))
+            while self.queue:
+                now = time.monotonic()
+                if not self.canSend(now, self.transactionTime(self.queue[0][2])):
+                    break
+                self.execute(ser, self.queue.popleft())
+
+    def stats(self):
+        return {
+            'injected': self.injected,
+            'failures': self.failures,
+            'period': self.period,
+            'busy': self.busy,
+            'turnaround': self.turnaround,
+        }
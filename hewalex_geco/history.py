@@ -0,0 +1,307 @@
+import math
+import mmap
+import os
+import struct
+import time
+
+
+# Memory mapped ring buffer store of decoded register values
+#
+# Keeps a high resolution history of every numeric register of a device class
+# in a single file of fixed size, so memory and disk use stay constant however
+# long it runs. The file holds four rings:
+#
+#   level 0: raw samples, one row per appended message
+#   level 1: 1 second rollups
+#   level 2: 1 minute rollups
+#   level 3: 1 hour rollups
+#
+# A raw row holds the timestamp and a float32 value per column; registers not
+# in the message keep their last value. A rollup row holds the start of its
+# bucket, the number of samples and min, avg and max per column. Rollups are
+# cascaded: a closed 1 second bucket is added to the open 1 minute bucket and
+# so on. The open bucket of each level is kept in the row after the newest
+# one, so it survives a restart and is included in queries.
+#
+# Example:
+#
+#   history = HistoryStore('pcwu.hist', PCWU)
+#   history.append(dev.parseRegistersView(sh["RestMessage"], sh["RegStart"], sh["RegLen"]))
+#   for t, samples, values in history.query(time.time() - 3600, resolution=60, names=['T1']):
+#       print(t, values['T1'])      # (min, avg, max)
+
+MAGIC = b'GECOHIS1'
+
+# Rollup intervals of the levels (seconds); 0 = raw samples
+LEVEL_INTERVALS = (0, 1, 60, 3600)
+
+# Default ring capacities: an hour of 500ms cycles, 6 hours of seconds, a week
+# of minutes and a year of hours
+DEFAULT_CAPACITIES = (7200, 21600, 10080, 8784)
+
+# Register types which don't decode to a number
+NON_NUMERIC_TYPES = ('date', 'time', 'tprg')
+
+LEVEL_HEADER = struct.Struct('<dIII')   # Interval, capacity, head, count
+
+
+# Names of the columns stored for a device class, in register order
+def historyColumns(devClass):
+    names = []
+    for regnum, reg in sorted(devClass.registers.items()):
+        if reg.get('type') in NON_NUMERIC_TYPES or 'name' not in reg:
+            continue
+        if reg['type'] == 'mask':
+            names.extend(name for name in reg['name'] if name is not None)
+        else:
+            names.append(reg['name'])
+    return list(dict.fromkeys(names))
+
+
+class HistoryLevel:
+
+    def __init__(self, store, num, interval, capacity, offset):
+        self.store = store
+        self.num = num
+        self.interval = interval
+        self.capacity = capacity
+        self.headerOffset = LEVEL_HEADER.size * num + store.levelsOffset
+        self.offset = offset                # Start of the ring in the file
+        ncols = len(store.columns)
+        if interval:
+            self.row = struct.Struct('<dI%df' % (3 * ncols))
+        else:
+            self.row = struct.Struct('<d%df' % ncols)
+        self.slots = capacity + 1           # One extra row for the open bucket
+        self.size = self.row.size * self.slots
+        self.head = 0                       # Row the next closed row is written to; holds the open bucket
+        self.count = 0                      # Number of closed rows in the ring
+        self.bucket = None                  # Start of the open bucket
+        self.samples = 0                    # Samples in the open bucket
+        self.mins = None
+        self.maxs = None
+        self.sums = None
+        self.ns = None                      # Samples per column in the open bucket
+
+    def rowOffset(self, pos):
+        return self.offset + self.row.size * pos
+
+    # Position in the ring of the i-th oldest closed row
+    def position(self, i):
+        return (self.head - self.count + i) % self.slots
+
+    def timeAt(self, i):
+        return struct.unpack_from('<d', self.store.mm, self.rowOffset(self.position(i)))[0]
+
+    def readHeader(self):
+        interval, capacity, self.head, self.count = LEVEL_HEADER.unpack_from(self.store.mm, self.headerOffset)
+        return interval == self.interval and capacity == self.capacity and self.head < self.slots and self.count <= capacity
+
+    def writeHeader(self):
+        LEVEL_HEADER.pack_into(self.store.mm, self.headerOffset, self.interval, self.capacity, self.head, self.count)
+
+    def writeRow(self, pos, values):
+        self.row.pack_into(self.store.mm, self.rowOffset(pos), *values)
+
+    # Append a closed row
+    def appendRow(self, values):
+        self.writeRow(self.head, values)
+        self.head = (self.head + 1) % self.slots
+        self.count = min(self.count + 1, self.capacity)
+        self.writeHeader()
+
+    def startBucket(self, bucket):
+        ncols = len(self.store.columns)
+        self.bucket = bucket
+        self.samples = 0
+        self.mins = [math.inf] * ncols
+        self.maxs = [-math.inf] * ncols
+        self.sums = [0.0] * ncols
+        self.ns = [0] * ncols
+
+    # Add a sample or a closed bucket of the level below to the open bucket
+    def add(self, t, samples, mins, avgs, maxs):
+        bucket = t - t % self.interval
+        if self.bucket is not None and bucket != self.bucket:
+            self.closeBucket()
+        if self.bucket is None:
+            self.startBucket(bucket)
+        self.samples += samples
+        for i, avg in enumerate(avgs):
+            if avg != avg:
+                continue    # NaN, no value yet
+            if mins[i] < self.mins[i]:
+                self.mins[i] = mins[i]
+            if maxs[i] > self.maxs[i]:
+                self.maxs[i] = maxs[i]
+            self.sums[i] += avg * samples
+            self.ns[i] += samples
+        self.writeRow(self.head, self.bucketRow())
+
+    def bucketRow(self):
+        row = [self.bucket, self.samples]
+        for i, n in enumerate(self.ns):
+            if n:
+                row.extend((self.mins[i], self.sums[i] / n, self.maxs[i]))
+            else:
+                row.extend((math.nan, math.nan, math.nan))
+        return row
+
+    def closeBucket(self):
+        row = self.bucketRow()
+        self.appendRow(row)
+        self.bucket = None
+        if self.num + 1 < len(self.store.levels):
+            self.store.levels[self.num + 1].add(row[0], row[1], row[2::3], row[3::3], row[4::3])
+
+    # Pick up the open bucket left in the file
+    def restoreBucket(self):
+        row = self.row.unpack_from(self.store.mm, self.rowOffset(self.head))
+        bucket, samples = row[0], row[1]
+        if not samples:
+            return
+        self.startBucket(bucket)
+        self.samples = samples
+        for i in range(len(self.store.columns)):
+            mn, avg, mx = row[2 + 3 * i:5 + 3 * i]
+            if avg == avg:
+                self.mins[i], self.maxs[i] = mn, mx
+                self.sums[i] = avg * samples
+                self.ns[i] = samples
+
+    # Index of the oldest closed row with a time of t or later
+    def find(self, t):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timeAt(mid) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Rows with start <= t < end, oldest first, open bucket included
+    def rows(self, start, end):
+        lo = self.find(start) if start is not None else 0
+        for i in range(lo, self.count):
+            row = self.row.unpack_from(self.store.mm, self.rowOffset(self.position(i)))
+            if end is not None and row[0] >= end:
+                return
+            yield row
+        if self.interval and self.bucket is not None:
+            if (start is None or self.bucket >= start) and (end is None or self.bucket < end):
+                yield tuple(self.bucketRow())
+
+
+class HistoryStore:
+
+    def __init__(self, path, devClass, capacities=DEFAULT_CAPACITIES, columns=None):
+        self.path = path
+        self.columns = list(columns) if columns is not None else historyColumns(devClass)
+        self.index = dict((name, i) for i, name in enumerate(self.columns))
+        self.values = [math.nan] * len(self.columns)    # Last value per column
+        self.lastTime = None                            # Timestamp of last sample
+
+        names = '\n'.join(self.columns).encode()
+        self.header = MAGIC + struct.pack('<II', len(self.columns), len(names)) + names
+        self.levelsOffset = len(self.header)
+        offset = self.levelsOffset + LEVEL_HEADER.size * len(LEVEL_INTERVALS)
+        offset += -offset % 8
+        self.levels = []
+        for num, (interval, capacity) in enumerate(zip(LEVEL_INTERVALS, capacities)):
+            level = HistoryLevel(self, num, interval, capacity, offset)
+            self.levels.append(level)
+            offset += level.size
+        self.size = offset
+
+        self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        existing = os.path.getsize(path)
+        if existing != self.size:
+            self.file.truncate(self.size)
+        self.mm = mmap.mmap(self.file.fileno(), self.size)
+        if existing != self.size or not self.load():
+            self.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Pick up the contents of an existing file; False if its layout differs
+    def load(self):
+        if self.mm[:len(self.header)] != self.header:
+            return False
+        if not all(level.readHeader() for level in self.levels):
+            return False
+        raw = self.levels[0]
+        if raw.count:
+            row = raw.row.unpack_from(self.mm, raw.rowOffset(raw.position(raw.count - 1)))
+            self.lastTime = row[0]
+            self.values = list(row[1:])
+        for level in self.levels[1:]:
+            level.restoreBucket()
+        return True
+
+    def clear(self):
+        self.mm[:self.size] = bytes(self.size)
+        self.mm[:len(self.header)] = self.header
+        for level in self.levels:
+            level.head = level.count = 0
+            level.bucket = None
+            level.writeHeader()
+        self.values = [math.nan] * len(self.columns)
+        self.lastTime = None
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+            self.mm = None
+            self.file.close()
+
+    # Store the values of a message (dict or RegisterView of name => value)
+    # at time t; registers not in mp keep their last value
+    def append(self, mp, t=None):
+        if t is None:
+            t = time.time()
+        if self.lastTime is not None and t < self.lastTime:
+            t = self.lastTime       # Clock stepped back; keep rows in order
+        self.lastTime = t
+        values = self.values
+        index = self.index
+        for name in mp:
+            i = index.get(name)
+            if i is not None:
+                val = mp[name]
+                if val is not None:
+                    values[i] = float(val)
+        self.levels[0].appendRow([t] + values)
+        self.levels[1].add(t, 1, values, values, values)
+
+    # Coarsest level with an interval of at most resolution seconds
+    def selectLevel(self, resolution=None):
+        for level in reversed(self.levels):
+            if resolution is not None and level.interval <= resolution:
+                return level
+        return self.levels[0]
+
+    # Rows from start up to end at the given resolution, as (t, values) for
+    # raw samples and (t, samples, values) for rollups, where values maps
+    # names (all columns by default) to a value or a (min, avg, max) tuple
+    def query(self, start=None, end=None, resolution=None, names=None):
+        level = self.selectLevel(resolution)
+        cols = [(name, self.index[name]) for name in (names if names is not None else self.columns)]
+        ret = []
+        for row in level.rows(start, end):
+            if level.interval:
+                ret.append((row[0], row[1], dict((name, row[2 + 3 * i:5 + 3 * i]) for name, i in cols)))
+            else:
+                ret.append((row[0], dict((name, row[1 + i]) for name, i in cols)))
+        return ret
+
+    def stats(self):
+        return dict((level.interval, {'rows': level.count, 'capacity': level.capacity}) for level in self.levels)
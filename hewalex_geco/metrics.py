@@ -0,0 +1,163 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import threading
+
+
+# Counters and timing histograms of bus transactions
+#
+# Devices, connections and the plugin record into a shared Metrics instance:
+# counters are incremented with inc(name) and timings (seconds) go into
+# histograms with observe(name, seconds). Components which keep their own
+# counters (eg. the frame parser) are added as sources and read at snapshot
+# time. snapshot() returns everything as plain dicts; prometheus() renders the
+# same as Prometheus text format, which writePrometheus() stores atomically for
+# the node exporter textfile collector.
+#
+# Names follow Prometheus conventions: counters end in _total and timings in
+# _seconds.
+#
+# Example:
+#
+#   metrics = Metrics()
+#   dev.setMetrics(metrics)
+#   dev.readStatusRegisters(ser)
+#   print(metrics.snapshot()['histograms']['transaction_first_byte_seconds'])
+#   metrics.writePrometheus('/var/lib/node_exporter/hewalex.prom')
+
+# Upper bounds of histogram buckets (seconds)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+PROMETHEUS_PREFIX = 'hewalex_'
+
+
+def snakeCase(name):
+    return re.sub(r'(?<=[a-z0-9])([A-Z])', r'_\1', name).lower()
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)     # Last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    # Cumulative counts per upper bound, like Prometheus
+    def cumulative(self):
+        ret = []
+        total = 0
+        for bound, cnt in zip(self.buckets + (float('inf'),), self.counts):
+            total += cnt
+            ret.append((bound, total))
+        return ret
+
+    # Upper bound of the bucket holding quantile q (0..1) of the observations
+    def quantile(self, q):
+        if not self.count:
+            return None
+        for bound, total in self.cumulative():
+            if total >= q * self.count:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': self.cumulative(),
+        }
+
+
+class Metrics:
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()    # Recorded from the worker and plugin threads
+        self.counters = {}              # Name => count
+        self.histograms = {}            # Name => Histogram
+        self.sources = {}               # Prefix => function returning a dict of counters
+
+    def inc(self, name, num=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + num
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    # Read counters of another component at snapshot time, eg.
+    # addSource('parser', parser.stats) gives parser_bad_frames_total
+    def addSource(self, prefix, func):
+        self.sources[prefix] = func
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict((name, histogram.snapshot()) for name, histogram in self.histograms.items())
+        for prefix, func in self.sources.items():
+            for key, val in func().items():
+                if isinstance(val, (int, float)) and not isinstance(val, bool):
+                    counters["%s_%s_total" % (prefix, snakeCase(key))] = val
+        return {
+            'counters': counters,
+            'histograms': histograms,
+        }
+
+    def prometheus(self, prefix=PROMETHEUS_PREFIX):
+        snapshot = self.snapshot()
+        lines = []
+        for name, val in sorted(snapshot['counters'].items()):
+            lines.append("# TYPE %s%s counter" % (prefix, name))
+            lines.append("%s%s %s" % (prefix, name, val))
+        for name, h in sorted(snapshot['histograms'].items()):
+            lines.append("# TYPE %s%s histogram" % (prefix, name))
+            for bound, total in h['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s%s_bucket{le="%s"} %d' % (prefix, name, le, total))
+            lines.append("%s%s_sum %r" % (prefix, name, h['sum']))
+            lines.append("%s%s_count %d" % (prefix, name, h['count']))
+        return "\n".join(lines) + "\n"
+
+    # Write the Prometheus text to path, replacing it atomically
+    def writePrometheus(self, path, prefix=PROMETHEUS_PREFIX):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus(prefix))
+        os.replace(tmp, path)
+
+
+# Run func(*args) under cProfile; returns (result, text of the top limit
+# functions by cumulative time)
+def profileCall(func, *args, limit=20, **kwargs):
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        profile.disable()
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(limit)
+    return result, out.getvalue()
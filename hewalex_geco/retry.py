@@ -0,0 +1,149 @@
+import random
+import threading
+import time
+
+
+# Retries of single requests and a circuit breaker for unreachable devices
+#
+# A RetryPolicy retries one request frame, not a whole sequence of them, so
+# the frames of a poll which succeeded are kept and only the failed one is
+# sent again. Between attempts it backs off exponentially (baseDelay, twice
+# that, ... up to maxDelay) with random jitter, so retries of several
+# instances on one gateway don't line up.
+#
+# A CircuitBreaker counts consecutive failed requests. After threshold of them
+# the circuit opens: polling stops and only a single probe is allowed every
+# probeInterval seconds, which grows by growth after every failed probe up to
+# maxProbeInterval. The first request that succeeds closes the circuit again.
+#
+# Example:
+#
+#   policy = RetryPolicy(maxAttempts=3)
+#   breaker = CircuitBreaker()
+#   for start, num in dev.planReads(names):
+#       if not breaker.allow():
+#           break
+#       try:
+#           policy.call(connection.call, dev.readRegisters, start, num)
+#       except Exception:
+#           breaker.failure()
+#       else:
+#           breaker.success()
+
+CLOSED = 'closed'           # Requests go through
+OPEN = 'open'               # Requests are refused until the next probe is due
+HALF_OPEN = 'half-open'     # A probe is under way
+
+
+class RetryPolicy:
+
+    def __init__(self, maxAttempts=3, baseDelay=0.1, maxDelay=2.0, jitter=0.5, seed=None):
+        self.maxAttempts = maxAttempts      # Attempts per request, the first one included
+        self.baseDelay = baseDelay          # Delay after the first failed attempt (seconds)
+        self.maxDelay = maxDelay            # Upper limit of the delay (seconds)
+        self.jitter = jitter                # Fraction of the delay which is random
+        self.random = random.Random(seed)
+
+    # Delay after the given failed attempt
+    def delay(self, attempt):
+        delay = min(self.maxDelay, self.baseDelay * 2 ** (attempt - 1))
+        return delay * (1 - self.jitter * self.random.random())
+
+    # Call func(*args, **kwargs) until it doesn't raise or attempts run out, in
+    # which case the last exception is raised. onRetry(attempt, exception) is
+    # called before every retry and sleep(delay) does the waiting.
+    def call(self, func, *args, attempts=None, sleep=time.sleep, onRetry=None, **kwargs):
+        if attempts is None:
+            attempts = self.maxAttempts
+        for attempt in range(1, attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt >= attempts:
+                    raise
+                if onRetry:
+                    onRetry(attempt, e)
+                sleep(self.delay(attempt))
+
+
+class CircuitBreaker:
+
+    def __init__(self, threshold=3, probeInterval=10.0, maxProbeInterval=600.0, growth=2.0, onChange=None):
+        self.threshold = threshold                  # Consecutive failures which open the circuit
+        self.probeInterval = probeInterval          # First time between probes (seconds)
+        self.maxProbeInterval = maxProbeInterval    # Upper limit of the time between probes (seconds)
+        self.growth = growth                        # Factor the interval grows by after a failed probe
+        self.onChange = onChange                    # Called as onChange(breaker, state) when it opens or closes
+        self.lock = threading.Lock()                # Used from the worker and plugin threads
+        self.state = CLOSED
+        self.failures = 0                           # Consecutive failures
+        self.interval = probeInterval               # Current time between probes
+        self.nextProbe = None                       # Time the next probe is allowed
+        self.opens = 0                              # Number of times the circuit opened
+        self.probes = 0                             # Number of probes allowed
+        self.rejected = 0                           # Number of requests refused
+
+    # May a request be sent? While open, True only once per probe interval
+    def allow(self, now=None):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if now is None:
+                now = time.monotonic()
+            if now < self.nextProbe:
+                self.rejected += 1
+                return False
+            # Also when a probe got lost without reporting back
+            self.state = HALF_OPEN
+            self.nextProbe = now + self.interval
+            self.probes += 1
+            return True
+
+    def isProbing(self):
+        return self.state == HALF_OPEN
+
+    def success(self):
+        with self.lock:
+            changed = self.state != CLOSED
+            self.state = CLOSED
+            self.failures = 0
+            self.interval = self.probeInterval
+            self.nextProbe = None
+        if changed and self.onChange:
+            self.onChange(self, CLOSED)
+
+    # Record a failed request; returns True if the circuit is open now
+    def failure(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            self.failures += 1
+            changed = False
+            if self.state == HALF_OPEN:
+                self.interval = min(self.interval * self.growth, self.maxProbeInterval)
+                self.state = OPEN
+                self.nextProbe = now + self.interval
+            elif self.state == CLOSED and self.failures >= self.threshold:
+                self.state = OPEN
+                self.nextProbe = now + self.interval
+                self.opens += 1
+                changed = True
+            isOpen = self.state == OPEN
+        if changed and self.onChange:
+            self.onChange(self, OPEN)
+        return isOpen
+
+    # Seconds until the next probe; 0 if requests are allowed
+    def timeUntilProbe(self, now=None):
+        if self.state == CLOSED:
+            return 0.0
+        if now is None:
+            now = time.monotonic()
+        return max(0.0, self.nextProbe - now)
+
+    def stats(self):
+        return {
+            'opens': self.opens,
+            'probes': self.probes,
+            'rejected': self.rejected,
+        }
@@ -0,0 +1,175 @@
+import collections
+import threading
+import time
+
+
+# Bus scheduler for several devices on one RS485 line
+#
+# Two devices on one bus (eg. a PCWU and a ZPS behind one gateway) must never
+# be talked to at the same time. The scheduler owns the connection and does all
+# transactions for all devices, one at a time. Each device is polled every
+# `interval` seconds; a poll is split into one transaction per register block so
+# a long config read of one device doesn't hold up the others. When several
+# devices are due at the same time their transactions are interleaved by smooth
+# weighted round robin: a device with weight 2 gets two transactions for every
+# one of a device with weight 1. Commands submitted by the user go before polls.
+# Frames are passed to the onMessage of the device they were read for.
+#
+# Example:
+#
+#   sched = BusScheduler(Connection('socket://192.168.12.34:8899'))
+#   sched.addDevice(PCWU(1, 1, 2, 2, onMessage), interval=60)
+#   sched.addDevice(ZPS(1, 1, 3, 3, onMessage), interval=30, weight=2)
+#   sched.submit(pcwu, 'writeRegister', 'TapWaterTemp', 500)
+#   sched.run()
+#
+
+# Register blocks read by a full poll of dev: status registers and config
+# registers in blocks of REG_MAX_NUM
+def pollBlocks(dev):
+    blocks = [(dev.REG_STATUS_START, dev.REG_CONFIG_START - dev.REG_STATUS_START)]
+    start = dev.REG_CONFIG_START
+    while start < dev.REG_MAX_ADR:
+        num = min(dev.REG_MAX_ADR + 2 - start, dev.REG_MAX_NUM)
+        blocks.append((start, num))
+        start = start + num
+    return blocks
+
+
+class ScheduledDevice:
+
+    def __init__(self, dev, interval, weight=1, blocks=None):
+        self.dev = dev
+        self.interval = interval            # Time between the start of two polls (seconds)
+        self.weight = weight                # Share of transactions when several devices are due
+        self.blocks = blocks if blocks is not None else pollBlocks(dev)
+        self.pending = []                   # Blocks of the current poll still to be read
+        self.nextPoll = 0                   # Time next poll is due
+        self.currentWeight = 0              # Smooth weighted round robin state
+        self.polls = 0                      # Number of completed polls
+        self.transactions = 0               # Number of transactions done
+        self.errors = 0                     # Number of failed transactions
+        self.lastError = None
+
+    def isDue(self, now):
+        return bool(self.pending) or now >= self.nextPoll
+
+    def stats(self):
+        return {
+            'polls': self.polls,
+            'transactions': self.transactions,
+            'errors': self.errors,
+        }
+
+
+class BusScheduler:
+
+    def __init__(self, connection, onError=None):
+        self.connection = connection        # Connection owning the port
+        self.onError = onError              # Called as onError(dev, command, exception)
+        self.devices = []
+        self.commands = collections.deque() # (dev, command, args, kwargs) to run before polls
+        self.lock = threading.Lock()        # Held during every transaction
+        self.wakeup = threading.Event()     # Set when a command is submitted
+        self.running = False
+
+    def addDevice(self, dev, interval, weight=1, blocks=None):
+        entry = ScheduledDevice(dev, interval, weight, blocks)
+        self.devices.append(entry)
+        return entry
+
+    def getEntry(self, dev):
+        for entry in self.devices:
+            if entry.dev is dev:
+                return entry
+        return None
+
+    # Queue a call of a method of dev, eg. submit(pcwu, 'writeRegister', 'TapWaterTemp', 500)
+    def submit(self, dev, command, *args, **kwargs):
+        self.commands.append((dev, command, args, kwargs))
+        self.wakeup.set()
+
+    # Pick the device to do the next transaction for; None if nothing is due
+    def select(self, now):
+        due = [entry for entry in self.devices if entry.isDue(now)]
+        if not due:
+            return None
+        total = 0
+        best = None
+        for entry in due:
+            entry.currentWeight += entry.weight
+            total += entry.weight
+            if best is None or entry.currentWeight > best.currentWeight:
+                best = entry
+        best.currentWeight -= total
+        return best
+
+    def call(self, dev, command, *args, **kwargs):
+        with self.lock:
+            return self.connection.call(getattr(dev, command), *args, **kwargs)
+
+    # Do at most one transaction; returns True if one was done
+    def runOnce(self, now=None):
+        if self.commands:
+            dev, command, args, kwargs = self.commands.popleft()
+            try:
+                self.call(dev, command, *args, **kwargs)
+            except Exception as e:
+                self.error(self.getEntry(dev), dev, command, e)
+            return True
+
+        if now is None:
+            now = time.monotonic()
+        entry = self.select(now)
+        if entry is None:
+            return False
+        if not entry.pending:
+            entry.pending = list(entry.blocks)
+            # Keep to the interval, unless the poll is late by more than that
+            entry.nextPoll += entry.interval
+            if entry.nextPoll <= now:
+                entry.nextPoll = now + entry.interval
+        start, num = entry.pending.pop(0)
+        entry.transactions += 1
+        try:
+            with self.lock:
+                self.connection.call(entry.dev.readRegisters, start, num)
+                if entry.dev.lastLatency is None:
+                    raise Exception("No response to read of %d registers from %d" % (num, start))
+        except Exception as e:
+            entry.pending = []      # Give up on this poll; try again next interval
+            self.error(entry, entry.dev, 'readRegisters', e)
+            return True
+        if not entry.pending:
+            entry.polls += 1
+        return True
+
+    def error(self, entry, dev, command, e):
+        if entry is not None:
+            entry.errors += 1
+            entry.lastError = e
+        if self.onError:
+            self.onError(dev, command, e)
+
+    # Seconds until the next transaction is due; None if there are no devices
+    def timeUntilDue(self, now=None):
+        if self.commands:
+            return 0.0
+        if now is None:
+            now = time.monotonic()
+        delays = [0.0 if entry.pending else max(0.0, entry.nextPoll - now) for entry in self.devices]
+        return min(delays) if delays else None
+
+    def run(self):
+        self.running = True
+        while self.running:
+            if not self.runOnce():
+                self.wakeup.wait(self.timeUntilDue())
+                self.wakeup.clear()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+    def stats(self):
+        return dict((type(entry.dev).__name__ + str(entry.dev.devHardId), entry.stats()) for entry in self.devices)
@@ -0,0 +1,296 @@
+import random
+import socket
+import threading
+import time
+
+from .devices.parser import FrameParser
+
+
+# Virtual Geco device on a local TCP port
+#
+# Serves a register image shaped like the registers of a device class to
+# clients connecting to socket://host:port, like an RS485 to TCP gateway with
+# a device behind it. Read (0x40) and write (0x60) requests to the device are
+# answered as the device would; requests beyond REG_MAX_NUM or REG_MAX_ADR are
+# ignored. With cycle enabled the controller/device traffic of an eavesdropped
+# bus is emulated too: every cycleTime seconds the device reads 20 controller
+# registers from 100, writes its status registers and reads register 252,
+# spread over about 140ms, and all of it is sent to every client.
+#
+# To mimic a real bus, responses can be delayed by responseDelay seconds, sent
+# in chunks with up to jitter seconds between bytes and corrupted (one byte of
+# the frame flipped, so its CRC no longer matches) with probability corruptRate.
+#
+# Example:
+#
+#   with Simulator(PCWU, cycle=True, responseDelay=0.02) as sim:
+#       ser = serial.serial_for_url(sim.url)
+#       ...
+#
+# or from the command line: python -m hewalex_geco.simulator --device PCWU --port 8899
+
+CYCLE_TIME = 0.5            # Time between the start of two cycles (seconds)
+CYCLE_FRAME_GAP = 0.025     # Time between the frames of a cycle (seconds)
+
+# Initial values of registers, by name, on top of the generated ones
+DEFAULT_VALUES = {
+    'IsManual': 2,          # PCWU controller on
+}
+
+
+class Simulator:
+
+    def __init__(self, devClass, conHardId=1, conSoftId=1, devHardId=2, devSoftId=2, host='127.0.0.1', port=0,
+            cycle=False, cycleTime=CYCLE_TIME, responseDelay=0.0, jitter=0.0, corruptRate=0.0, seed=None):
+        self.dev = devClass(conHardId, conSoftId, devHardId, devSoftId, None)
+        self.host = host
+        self.port = port
+        self.cycle = cycle
+        self.cycleTime = cycleTime
+        self.responseDelay = responseDelay
+        self.jitter = jitter
+        self.corruptRate = corruptRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()                    # Protects image and clients
+        self.image = bytearray(self.dev.REG_MAX_ADR + 2)  # Register number => byte offset of its value
+        self.controllerImage = bytearray(self.dev.REG_MAX_ADR + 2)
+        self.clients = {}                               # Socket => lock held while sending a frame
+        self.sock = None
+        self.running = False
+        self.threads = []
+        self.requests = 0                               # Number of valid requests received
+        self.responses = 0                              # Number of responses sent
+        self.ignored = 0                                # Number of requests not answered
+        self.corrupted = 0                              # Number of frames corrupted on purpose
+        self.cycles = 0                                 # Number of cycles sent
+        self.initImage()
+
+    @property
+    def url(self):
+        return "socket://%s:%d" % (self.host, self.port)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    # Fill registers with plausible values: temperatures around 20 degrees, the
+    # current date and time and zeroes otherwise
+    def initImage(self):
+        dev = self.dev
+        for regnum, reg in dev.registers.items():
+            if reg.get('type') in ('te10', 'fl10'):
+                self.setWord(regnum, 200 + (regnum % 50))
+            elif reg.get('type') == 'temp':
+                self.setWord(regnum, 20 + (regnum % 5))
+        for name, val in DEFAULT_VALUES.items():
+            if dev.getRegisterByName(name) is not None:
+                self.set(name, val)
+        self.setDateTime()
+        self.controllerImage[100:120] = bytes(range(0x30, 0x44))
+        self.controllerImage[252:256] = b'\x10\x00\x00\x00'     # Display on, no changes
+
+    def setDateTime(self, now=None):
+        t = time.localtime(now)
+        for regnum, reg in self.dev.registers.items():
+            if reg.get('type') == 'date':
+                self.image[regnum:regnum + 3] = bytes((t.tm_year % 100, t.tm_mon, t.tm_mday))
+            elif reg.get('type') == 'time':
+                self.image[regnum:regnum + 3] = bytes((t.tm_hour, t.tm_min, t.tm_sec))
+
+    def setWord(self, regnum, val):
+        self.image[regnum] = val & 0xff
+        self.image[regnum + 1] = (val >> 8) & 0xff
+
+    def getWord(self, regnum):
+        return self.image[regnum] | (self.image[regnum + 1] << 8)
+
+    # Set a register by name to an unscaled value, eg. set('T1', 21.5)
+    def set(self, regname, val):
+        regnum = self.dev.registerMap.getRegisterNumber(regname)
+        with self.lock:
+            self.setWord(regnum, self.dev.encodeRegister(regname, val))
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.running = True
+        self.startThread(self.serve)
+        if self.cycle:
+            self.startThread(self.runCycles)
+        return self.url
+
+    def startThread(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def stop(self):
+        self.running = False
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.close()
+        for thread in self.threads:
+            thread.join(1)
+        self.threads = []
+
+    def serve(self):
+        while self.running:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                break
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.clients[client] = threading.Lock()
+            self.startThread(self.serveClient, client)
+
+    def serveClient(self, client):
+        parser = FrameParser(self.dev)
+        try:
+            while self.running:
+                data = client.recv(4096)
+                if not data:
+                    break
+                for h, sh, frame in parser.feed(data):
+                    self.handleRequest(client, h, sh)
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.clients.pop(client, None)
+            client.close()
+
+    def handleRequest(self, client, h, sh):
+        dev = self.dev
+        if h["To"] != dev.devHardId or h["From"] != dev.conHardId:
+            return
+        self.requests += 1
+        start, num, fnc = sh["RegStart"], sh["RegLen"], sh["FNC"]
+        if num > dev.REG_MAX_NUM or start + num > dev.REG_MAX_ADR + 2 or fnc not in (0x40, 0x60):
+            self.ignored += 1
+            return
+        with self.lock:
+            if fnc == 0x40:
+                response = dev.createMessage(0x50, start, num, bytes(self.image[start:start + num]), fromDevice=True)
+            else:
+                data = bytes(sh["RestMessage"])
+                self.image[start:start + len(data)] = data
+                response = dev.createMessage(0x70, start, num, fromDevice=True)
+        if self.responseDelay:
+            time.sleep(self.responseDelay)
+        self.responses += 1
+        self.send(client, response)
+
+    # Send a frame to a client, possibly corrupted and with jitter between bytes
+    def send(self, client, frame):
+        frame = bytearray(frame)
+        if self.corruptRate and self.random.random() < self.corruptRate:
+            frame[self.random.randrange(1, len(frame))] ^= 0xff
+            self.corrupted += 1
+        with self.lock:
+            sendLock = self.clients.get(client, None)
+        if sendLock is None:
+            return
+        with sendLock:
+            if not self.jitter:
+                client.sendall(frame)
+                return
+            pos = 0
+            while pos < len(frame):
+                num = self.random.randint(1, 16)
+                client.sendall(frame[pos:pos + num])
+                pos += num
+                time.sleep(self.random.uniform(0, self.jitter))
+
+    def broadcast(self, frame):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                self.send(client, frame)
+            except OSError:
+                pass
+
+    # Frames of one controller/device cycle, as (frame, sent by device?)
+    def cycleFrames(self):
+        dev = self.dev
+        start = dev.REG_STATUS_START
+        num = dev.REG_CONFIG_START - start
+        with self.lock:
+            self.setDateTime()
+            status = bytes(self.image[start:start + num])
+            reg100 = bytes(self.controllerImage[100:120])
+            reg252 = bytes(self.controllerImage[252:256])
+        # Frames sent by the device are requests to the controller, so the
+        # controller/device roles of createMessage are swapped
+        return [
+            dev.createMessage(0x40, 100, 20, fromDevice=True),
+            dev.createMessage(0x50, 100, 20, reg100),
+            dev.createMessage(0x60, start, num, status, fromDevice=True),
+            dev.createMessage(0x70, start, num),
+            dev.createMessage(0x40, 252, 4, fromDevice=True),
+            dev.createMessage(0x50, 252, 4, reg252),
+        ]
+
+    def runCycles(self):
+        nextCycle = time.monotonic()
+        while self.running:
+            for frame in self.cycleFrames():
+                self.broadcast(frame)
+                time.sleep(CYCLE_FRAME_GAP)
+            self.cycles += 1
+            nextCycle += self.cycleTime
+            time.sleep(max(0, nextCycle - time.monotonic()))
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'responses': self.responses,
+            'ignored': self.ignored,
+            'corrupted': self.corrupted,
+            'cycles': self.cycles,
+        }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from .devices import PCWU, ZPS
+
+    parser = argparse.ArgumentParser(description="Virtual Geco device")
+    parser.add_argument('--device', choices=['PCWU', 'ZPS'], default='PCWU')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8899)
+    parser.add_argument('--ids', default='1,1;2,2', help="Controller and device hard and soft ids")
+    parser.add_argument('--cycle', action='store_true', help="Emulate controller/device cycle")
+    parser.add_argument('--delay', type=float, default=0.0, help="Response delay (seconds)")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Maximum delay between bytes (seconds)")
+    parser.add_argument('--corrupt', type=float, default=0.0, help="Fraction of frames to corrupt")
+    args = parser.parse_args()
+
+    con, dev = args.ids.split(';')
+    conHardId, conSoftId = (int(x) for x in con.split(','))
+    devHardId, devSoftId = (int(x) for x in dev.split(','))
+    sim = Simulator(PCWU if args.device == 'PCWU' else ZPS, conHardId, conSoftId, devHardId, devSoftId,
+        args.host, args.port, cycle=args.cycle, responseDelay=args.delay, jitter=args.jitter, corruptRate=args.corrupt)
+    print("Serving %s on %s" % (args.device, sim.start()))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
+    print(sim.stats())
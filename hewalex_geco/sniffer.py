@@ -0,0 +1,142 @@
+import time
+
+from .devices.parser import FrameParser
+
+
+# Continuous cycle synchronized eavesdropper
+#
+# The controller and device talk in a fixed cycle of about 140ms of traffic
+# followed by about 360ms of silence. A cycle starts with the device reading 20
+# registers from address 100 of the controller; then the device writes its
+# status registers, reads register 252 and so on, each followed by a response.
+#
+# Instead of flushing the port and waiting for the start of a cycle on every
+# call, the sniffer keeps reading and stays locked to the cycle. Frames are
+# collected from the start marker until the bus goes quiet for gapTime seconds
+# (or the next start marker arrives) and the cycle is then handed over as a
+# whole. A cycle in which bytes had to be skipped by the frame parser is
+# incomplete and dropped. Lock is lost when no start marker was seen for
+# cycleTimeout seconds and regained on the next one.
+
+class Cycle:
+    __slots__ = ('start', 'end', 'frames')
+
+    def __init__(self, start):
+        self.start = start          # Time start marker was received
+        self.end = start            # Time last frame was received
+        self.frames = []            # List of (h, sh, frame)
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def __len__(self):
+        return len(self.frames)
+
+
+class CycleSniffer:
+
+    def __init__(self, dev, onCycle=None, onMessage=None, onSync=None, gapTime=0.1, cycleTimeout=1.0, pollTime=0.02, onFrame=None):
+        self.dev = dev
+        self.onCycle = onCycle              # Called as onCycle(sniffer, cycle) for every complete cycle
+        self.onFrame = onFrame              # Called as onFrame(sniffer, h, sh, frame, now) for every frame; True = consumed, not part of the cycle
+        self.onMessage = onMessage          # Called for every frame of a complete cycle; defaults to dev.onMessage
+        self.onSync = onSync                # Called as onSync(sniffer, locked) when lock is gained or lost
+        self.gapTime = gapTime              # Silence which ends a cycle (seconds)
+        self.cycleTimeout = cycleTimeout    # Time without start marker after which lock is lost (seconds)
+        self.pollTime = pollTime            # Read timeout while waiting for bytes (seconds)
+        self.parser = FrameParser(dev)
+        self.cycle = None                   # Cycle being collected
+        self.cycleDropped = 0               # Parser dropped bytes when current cycle started
+        self.locked = False                 # Locked to the cycle?
+        self.lastByte = None                # Time last bytes were received
+        self.lastStart = None               # Time last start marker was received
+        self.cycles = 0                     # Number of complete cycles handed over
+        self.damagedCycles = 0              # Number of cycles dropped because bytes were skipped
+        self.strayFrames = 0                # Number of frames received outside a cycle
+        self.losses = 0                     # Number of times lock was lost
+
+    # Forget partially received frames and cycle, eg. after reconnecting
+    def reset(self):
+        self.parser.reset()
+        self.cycle = None
+
+    def isCycleStart(self, h, sh):
+        return (h["From"] == self.dev.devHardId and h["To"] == self.dev.conHardId and
+            sh["FNC"] == 0x40 and sh["RegStart"] == 100 and sh["RegLen"] == 20)
+
+    def setLocked(self, locked):
+        if locked == self.locked:
+            return
+        self.locked = locked
+        if not locked:
+            self.losses += 1
+        if self.onSync:
+            self.onSync(self, locked)
+
+    def feed(self, data, now=None):
+        if now is None:
+            now = time.monotonic()
+        if data:
+            self.lastByte = now
+            for h, sh, frame in self.parser.feed(data):
+                if self.onFrame and self.onFrame(self, h, sh, frame, now):
+                    continue
+                self.addFrame(h, sh, frame, now)
+        self.tick(now)
+
+    def addFrame(self, h, sh, frame, now):
+        if self.isCycleStart(h, sh):
+            if self.cycle is not None:
+                self.endCycle()
+            self.cycle = Cycle(now)
+            self.cycleDropped = self.parser.droppedBytes
+            self.lastStart = now
+            self.setLocked(True)
+        if self.cycle is None:
+            self.strayFrames += 1
+            return
+        self.cycle.frames.append((h, sh, frame))
+        self.cycle.end = now
+
+    # Handle timeouts; ends a cycle once the bus went quiet and loses lock when the
+    # start marker stays away
+    def tick(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self.cycle is not None and now - self.lastByte >= self.gapTime:
+            self.endCycle()
+        if self.locked and now - self.lastStart > self.cycleTimeout:
+            self.setLocked(False)
+
+    def endCycle(self):
+        cycle = self.cycle
+        self.cycle = None
+        if self.parser.droppedBytes != self.cycleDropped:
+            self.damagedCycles += 1
+            return
+        self.cycles += 1
+        onMessage = self.onMessage if self.onMessage is not None else self.dev.onMessage
+        for h, sh, frame in cycle.frames:
+            self.dev.dispatchFrame(h, sh, frame, onMessage)
+        if self.onCycle:
+            self.onCycle(self, cycle)
+
+    # Sniff the bus until numCycles complete cycles were handed over or stop()
+    # returns True; returns the number of complete cycles
+    def run(self, ser, numCycles=None, stop=None):
+        cycles = self.cycles
+        ser.timeout = self.pollTime
+        while numCycles is None or self.cycles - cycles < numCycles:
+            if stop is not None and stop():
+                break
+            self.feed(ser.read(ser.in_waiting or 1))
+        return self.cycles - cycles
+
+    def stats(self):
+        return {
+            'cycles': self.cycles,
+            'damagedCycles': self.damagedCycles,
+            'strayFrames': self.strayFrames,
+            'losses': self.losses,
+            'locked': self.locked,
+        }
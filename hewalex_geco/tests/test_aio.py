@@ -0,0 +1,130 @@
+import asyncio
+import unittest
+
+import serial
+
+from hewalex_geco import aio
+from hewalex_geco.devices import PCWU, ZPS
+from hewalex_geco.simulator import Simulator
+
+
+# The async API must see the same messages and leave the device in the same
+# state as the blocking API, talking to the simulator over TCP
+
+def collect(messages):
+    def onMessage(dev, h, sh, m):
+        if sh["FNC"] in (0x50, 0x60):
+            values = dev.parseRegisters(sh["RestMessage"], sh["RegStart"], sh["RegLen"])
+        else:
+            values = bytes(sh["RestMessage"])
+        messages.append((sh["FNC"], sh["RegStart"], sh["RegLen"], values))
+    return onMessage
+
+
+class AsyncApiTest(unittest.TestCase):
+
+    def run(self, result=None):
+        with Simulator(self.devClass) as sim:
+            sim.setDateTime(0)     # Keep date and time registers the same between reads
+            self.sim = sim
+            return super().run(result)
+
+    devClass = PCWU
+
+    def readBlocking(self, calls):
+        messages = []
+        dev = self.devClass(1, 1, 2, 2, collect(messages))
+        ser = serial.serial_for_url(self.sim.url)
+        try:
+            for method, args in calls:
+                getattr(dev, method)(ser, *args)
+                self.assertIsNotNone(dev.lastLatency)
+        finally:
+            ser.close()
+        return messages
+
+    def readAsync(self, calls):
+        messages = []
+        dev = self.devClass(1, 1, 2, 2, collect(messages))
+
+        async def main():
+            conn = await aio.openConnection(self.sim.url)
+            try:
+                for method, args in calls:
+                    await getattr(aio, method)(dev, conn, *args)
+            finally:
+                conn.close()
+
+        asyncio.run(main())
+        return messages
+
+    def assertSameMessages(self, calls):
+        blocking = self.readBlocking(calls)
+        self.assertTrue(blocking)
+        self.assertEqual(self.readAsync(calls), blocking)
+
+    def testReadStatusRegisters(self):
+        self.assertSameMessages([('readStatusRegisters', ())])
+
+    def testReadConfigRegisters(self):
+        self.assertSameMessages([('readConfigRegisters', ())])
+
+    def testReadRegisters(self):
+        self.assertSameMessages([('readRegisters', (130, 20)), ('readRegister', (302,))])
+
+    def testWriteRegisters(self):
+        dev = self.devClass(1, 1, 2, 2, None)
+        name = 'TapWaterTemp' if self.devClass is PCWU else 'NightCoolingStartTemp'
+        regnum = dev.registerMap.getRegisterNumber(name)
+        self.assertSameMessages([('writeRegisters', (regnum, 2, [45])), ('readRegister', (regnum,))])
+        self.assertEqual(self.sim.getWord(regnum), 45)
+        self.assertSameMessages([('writeRegister', (name, 47)), ('readRegister', (regnum,))])
+        self.assertEqual(self.sim.getWord(regnum), 47)
+
+    def testNoResponse(self):
+        dev = self.devClass(1, 1, 5, 5, None)
+
+        async def main():
+            conn = await aio.openConnection(self.sim.url)
+            try:
+                await aio.readRegisters(dev, conn, 120, 20, timeout=0.1)
+            finally:
+                conn.close()
+
+        with self.assertRaises(Exception):
+            asyncio.run(main())
+
+
+class AsyncApiZPSTest(AsyncApiTest):
+    devClass = ZPS
+
+
+class AsyncEavesDropTest(unittest.TestCase):
+
+    # Eavesdropping and transactions on the same connection and device take
+    # turns on the bus instead of feeding each other's frames to the parser
+    def testConcurrentTransactions(self):
+        with Simulator(PCWU, cycle=True, cycleTime=0.3) as sim:
+            messages = []
+            dev = PCWU(1, 1, 2, 2, lambda dev, h, sh, m: messages.append(sh["FNC"]))
+
+            async def reads(conn):
+                for i in range(5):
+                    await aio.readRegisters(dev, conn, 120, 20)
+                    await asyncio.sleep(0.05)
+
+            async def main():
+                conn = await aio.openConnection(sim.url)
+                try:
+                    return await asyncio.gather(aio.eavesDrop(dev, conn, 2), reads(conn))
+                finally:
+                    conn.close()
+
+            cycles, _ = asyncio.run(main())
+        self.assertEqual(cycles, 2)
+        self.assertEqual(messages.count(0x50), 5 + 2 * 2)   # Reads and read responses of two cycles
+        self.assertEqual(dev.parser.badFrames, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
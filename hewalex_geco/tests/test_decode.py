@@ -0,0 +1,94 @@
+import random
+import unittest
+
+from hewalex_geco.devices import PCWU, ZPS
+from hewalex_geco.benchmarks.frames import pcwuCycle, pcwuConfigResponse, pcwuStatusResponse, zpsStatusResponse, zpsConfigResponses
+
+
+# Decode plans and register views must give exactly what the original register
+# walk (parseRegistersWalk) gives, for the frames of the benchmark corpus as well
+# as for random windows of the register images built from them.
+
+def payload(frame):
+    return frame[18:-2]
+
+# Register number => byte offset image of the corpus responses of a device
+def registerImage(dev, frames):
+    image = bytearray(dev.REG_MAX_ADR + 2)
+    for frame in frames:
+        start = frame[16] | (frame[17] << 8)
+        data = payload(frame)
+        image[start:start + len(data)] = data
+    return image
+
+
+class DecodeTest(unittest.TestCase):
+
+    def assertDecodes(self, dev, m, regstart, reglen):
+        for unknown in (False, True):
+            try:
+                expected = dev.parseRegistersWalk(m, regstart, reglen, unknown)
+            except IndexError:
+                # Window ends inside a register which takes two slots
+                with self.assertRaises(IndexError):
+                    dev.parseRegisters(m, regstart, reglen, unknown)
+                continue
+            plan = dev.getDecodePlan(regstart, reglen, unknown)
+            self.assertTrue(plan.matches(m))
+            decoded = plan.decode(m)
+            self.assertEqual(decoded, expected)
+            self.assertEqual(list(decoded), list(expected))
+            self.assertEqual(dev.parseRegisters(m, regstart, reglen, unknown), expected)
+
+            # Lazily, in random order and then all at once
+            view = dev.parseRegistersView(m, regstart, reglen, unknown)
+            names = list(expected)
+            random.Random(regstart).shuffle(names)
+            for name in names[:len(names) // 2]:
+                self.assertIn(name, view)
+                self.assertEqual(view[name], expected[name])
+            self.assertEqual(len(view), len(expected))
+            self.assertEqual(dict(view), expected)
+            self.assertEqual(view.decodeAll(), expected)
+            self.assertEqual(list(view.decodeAll()), list(expected))
+
+    def assertDecodesFrames(self, dev, frames):
+        for frame in frames:
+            if frame[12] not in (0x50, 0x60):
+                continue    # No registers in read requests and write acknowledgements
+            start = frame[16] | (frame[17] << 8)
+            self.assertDecodes(dev, payload(frame), start, frame[15])
+
+    def assertDecodesWindows(self, dev, image, first, num, seed=0):
+        rnd = random.Random(seed)
+        for i in range(num):
+            regstart = first + 2 * rnd.randrange((len(image) - first) // 2)
+            reglen = rnd.randint(1, min(dev.REG_MAX_NUM, len(image) - regstart))
+            self.assertDecodes(dev, bytes(image[regstart:regstart + reglen]), regstart, reglen)
+
+    def testPCWUCorpus(self):
+        self.assertDecodesFrames(PCWU(1, 1, 2, 2, None), [pcwuStatusResponse(), pcwuConfigResponse()] + pcwuCycle())
+
+    def testZPSCorpus(self):
+        self.assertDecodesFrames(ZPS(1, 1, 2, 2, None), [zpsStatusResponse()] + zpsConfigResponses())
+
+    def testPCWUWindows(self):
+        dev = PCWU(1, 1, 2, 2, None)
+        image = registerImage(dev, [pcwuStatusResponse(), pcwuConfigResponse()])
+        self.assertDecodesWindows(dev, image, dev.REG_STATUS_START, 2000)
+
+    def testZPSWindows(self):
+        dev = ZPS(1, 1, 2, 2, None)
+        image = registerImage(dev, [zpsStatusResponse()] + zpsConfigResponses())
+        self.assertDecodesWindows(dev, image, dev.REG_STATUS_START, 2000)
+
+    def testRandomRegisterValues(self):
+        rnd = random.Random(1)
+        for devClass in (PCWU, ZPS):
+            dev = devClass(1, 1, 2, 2, None)
+            image = bytearray(rnd.getrandbits(8) for i in range(dev.REG_MAX_ADR + 2))
+            self.assertDecodesWindows(dev, image, dev.REG_STATUS_START, 1000, seed=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
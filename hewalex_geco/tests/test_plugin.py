@@ -0,0 +1,93 @@
+import sys
+import types
+import unittest
+
+# plugin.py imports the Domoticz module, which only exists inside Domoticz
+if 'Domoticz' not in sys.modules:
+    Domoticz = types.ModuleType('Domoticz')
+    Domoticz.Debug = Domoticz.Log = Domoticz.Error = lambda message: None
+    sys.modules['Domoticz'] = Domoticz
+
+import plugin
+
+
+class DeadbandTest(unittest.TestCase):
+
+    # Every step of 0.1 and 0.2 degrees from 0 to 70, as the plugin formats them
+    def steps(self, step):
+        for i in range(700):
+            last = i / 10.0
+            yield str(round(last + step, 1)), str(last)
+
+    def testStepOfDeadbandIsSuppressed(self):
+        for sValue, lastsValue in self.steps(0.1):
+            self.assertFalse(plugin.IsChanged(sValue, lastsValue, 0.1), (sValue, lastsValue))
+            self.assertFalse(plugin.IsChanged(lastsValue, sValue, 0.1), (lastsValue, sValue))
+
+    def testStepOverDeadbandIsChanged(self):
+        for sValue, lastsValue in self.steps(0.2):
+            self.assertTrue(plugin.IsChanged(sValue, lastsValue, 0.1), (sValue, lastsValue))
+            self.assertTrue(plugin.IsChanged(lastsValue, sValue, 0.1), (lastsValue, sValue))
+
+    def testNoDeadband(self):
+        self.assertTrue(plugin.IsChanged("20.1", "20.0", 0))
+        self.assertFalse(plugin.IsChanged("20.0", "20.0", 0))
+
+    def testMultipleValues(self):
+        self.assertFalse(plugin.IsChanged("20.1;30.0", "20.0;30.1", 0.1))
+        self.assertTrue(plugin.IsChanged("20.1;30.0", "20.0;30.2", 0.1))
+        self.assertTrue(plugin.IsChanged("20.0;on", "20.0;off", 0.1))
+
+
+
+class Updates:
+
+    def __init__(self):
+        self.values = []
+
+    def set(self, unit, nValue, sValue):
+        self.values.append((unit, nValue, sValue))
+
+
+class Device:
+
+    def __init__(self, mp):
+        self.mp = mp
+
+    def parseRegistersView(self, m, regstart, reglen):
+        return self.mp
+
+
+class CompressorTimeTest(unittest.TestCase):
+
+    # Handle the status messages of an eavesdropping plugin, received at the
+    # given times with the compressor on or off, all at once
+    def handle(self, messages):
+        p = plugin.BasePlugin()
+        p.devMode = 1
+        p.custom_data = {}
+        p.dispatch = {}
+        p.updates = Updates()
+        plugin.AddDispatch(p, 'CompressorON', 26, plugin.CompressorTimeHandler)
+        sh = {"FNC": 0x60, "RestMessage": b'', "RegStart": 120, "RegLen": 182}
+        for t, on in messages:
+            p.messageTime = t
+            p.onMessagePCWU(Device({'CompressorON': on}), {}, sh, b'')
+        return sum(int(sValue) for unit, nValue, sValue in p.updates.values)
+
+    def testTimeOfArrival(self):
+        # Every 500ms cycle, on from 1000.0 to 1007.5 (15 cycles)
+        messages = [(1000 + i / 2.0, 1 <= i <= 15) for i in range(30)]
+        self.assertEqual(self.handle(messages), 7)
+
+    def testFractionsCarriedOver(self):
+        # 20 intervals of 300ms; rounding each one would count nothing
+        self.assertEqual(self.handle([(1000 + i * 0.3, True) for i in range(21)]), 6)
+
+    def testOffMidBatch(self):
+        messages = [(1000.0, True), (1000.5, True), (1001.0, False), (1004.0, False), (1004.5, True)]
+        self.assertEqual(self.handle(messages), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import threading
+import time
+
+
+# Debouncing and coalescing register write queue
+#
+# Dragging a slider or flipping several settings in a row results in a burst of
+# single register writes. Writes added to this queue are held until no new
+# write arrived for `window` seconds (or the oldest pending write is `maxDelay`
+# seconds old); repeated writes to the same register only keep the last value.
+# Pending writes to adjacent registers are then merged into multi-register write
+# messages which respect REG_MAX_NUM of the device. The queue is thread safe, so
+# writes can be added from one thread and flushed from another.
+
+class WriteQueue:
+
+    def __init__(self, dev, window=0.5, maxDelay=None):
+        self.dev = dev
+        self.window = window
+        self.maxDelay = maxDelay if maxDelay is not None else 5 * window
+        self.lock = threading.Lock()
+        self.values = {}            # Register number => value of pending write
+        self.firstChange = None     # Time first pending write was added
+        self.lastChange = None      # Time last pending write was added
+        self.added = 0              # Number of writes added
+        self.written = 0            # Number of write messages sent
+
+    # Queue a write of val to a register (name or number). Mask bits can't be
+    # written on their own, as the whole word they are in is written.
+    def add(self, reg, val, now=None):
+        if isinstance(reg, str):
+            if reg in self.dev.registerMap.bits:
+                raise ValueError("Can't queue a write of mask bit %s; write its register instead" % reg)
+            reg = self.dev.registerMap.getRegisterNumber(reg)
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            self.values[reg] = val
+            if self.firstChange is None:
+                self.firstChange = now
+            self.lastChange = now
+            self.added += 1
+
+    def pending(self):
+        return len(self.values)
+
+    # Seconds until pending writes are due; None if there are none
+    def timeUntilDue(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            if not self.values:
+                return None
+            due = min(self.lastChange + self.window, self.firstChange + self.maxDelay)
+            return max(0.0, due - now)
+
+    # Take pending writes if due (or forced) as a list of (start, num, values)
+    def take(self, now=None, force=False):
+        if not force and self.timeUntilDue(now) != 0.0:
+            return []
+        with self.lock:
+            values = self.values
+            self.values = {}
+            self.firstChange = None
+            self.lastChange = None
+        return self.coalesce(values)
+
+    def coalesce(self, values):
+        maxNum = self.dev.REG_MAX_NUM
+        runs = []
+        for regnum in sorted(values):
+            if runs:
+                start, vals = runs[-1]
+                if regnum == start + 2 * len(vals) and (maxNum is None or 2 * (len(vals) + 1) <= maxNum):
+                    vals.append(values[regnum])
+                    continue
+            runs.append((regnum, [values[regnum]]))
+        return [(start, 2 * len(vals), vals) for start, vals in runs]
+
+    def flush(self, ser, onMessage=None, force=False):
+        writes = self.take(force=force)
+        for start, num, vals in writes:
+            self.written += 1
+            self.dev.writeRegisters(ser, start, num, vals, onMessage=onMessage)
+        return writes
@@ -57,18 +57,31 @@
 """
 
 
-import serial
+import itertools
+import queue
+import threading
 import time
 import Domoticz
 
+from hewalex_geco.connection import Connection
 from hewalex_geco.devices import PCWU, ZPS
+from hewalex_geco.history import HistoryStore
+from hewalex_geco.metrics import Metrics, profileCall
+from hewalex_geco.retry import RetryPolicy, CircuitBreaker, OPEN
+from hewalex_geco.sniffer import CycleSniffer
+from hewalex_geco.writequeue import WriteQueue
 
 
 class BasePlugin:
     enabled = False
     lastPolled = 0
     devAddr = None
-    maxAttempts = 3
+    maxAttempts = 3             # Attempts per request frame of a poll
+    retryBaseDelay = 0.1        # Delay before the first retry, doubled for every next one (seconds)
+    retryMaxDelay = 1.0         # Maximum delay between retries (seconds)
+    breakerThreshold = 3        # Consecutive failed requests after which polling is suspended
+    breakerProbeInterval = 10   # Time between probes of a suspended device, at first (seconds)
+    breakerMaxProbeInterval = 600   # Maximum time between probes of a suspended device (seconds)
 
     conHardId = 1
     conSoftId = 1       # Controller hard and soft Ids
@@ -77,9 +90,33 @@ class BasePlugin:
 
     devMode = None      # Operating mode of device (1 = PCWU - Eavesdropping, 2 = PCWU - Direct comms, 3 = ZPS - Direct comms)
     devReady = False    # Is device ready to accept commands?
+    pollInterval = None # Time between polls of the device (seconds)
 
     expertMode = False  # Expert mode enabled?
 
+    connection = None   # Persistent connection to serial port or gateway
+    dev = None          # Hewalex device instance
+    worker = None       # Background thread doing all bus I/O
+    onMessage = None    # Message handler for device (onMessagePCWU or onMessageZPS)
+    pollsPending = 0    # Number of polls queued or in progress
+    writes = None       # Debouncing and coalescing register write queue
+    writeWindow = 0.5   # Time without changes before pending writes are sent (seconds)
+    sniffer = None      # Continuous eavesdropper locked to the bus cycle (eavesdropping mode only)
+    sniffRetryDelay = 5 # Time to wait before sniffing again after an I/O error (seconds)
+    updates = None      # Deadband and coalescing filter for Domoticz device updates
+    tempDeadband = 0.1          # Changes of temperatures up to this much aren't updated (degrees)
+    updateMinInterval = 0       # Minimum time between updates of a device (seconds)
+    updateMaxInterval = 300     # Maximum time without an update of a sensor device (seconds)
+    history = None      # Memory mapped history of all decoded values
+    messageTime = None  # Time the message being handled was received
+    metrics = None      # Timings and error counters of bus transactions and heartbeats
+    metricsPath = None  # File to write metrics to in Prometheus text format every heartbeat (None = don't)
+    profileHeartbeats = False   # Run every heartbeat under cProfile and log where the time goes?
+    retryPolicy = None  # Retries of failed request frames
+    breaker = None      # Circuit breaker suspending polls of an unreachable device
+    lastProfile = None  # Profile of the last heartbeat
+    historyPath = None  # File of the history, eg. Parameters["HomeFolder"] + "history.bin" (None = no history)
+
     serial_parameters = { 'baudrate': 38400, 'bytesize': 8, 'parity': 'N', 'stopbits': 1 }
     temp_devices = {}
     switch_devices = {}
@@ -88,6 +125,8 @@ class BasePlugin:
     x_custom_devices = {}
 
     custom_data = {}
+    dispatch = {}       # Register name => list of (unit, handler, required register names)
+    readPlan = None     # (start, num) reads of a poll, covering only the registers in use
 
     def __init__(self):
         return
@@ -103,6 +142,8 @@ class BasePlugin:
         self.devMode = int(Parameters["Mode2"])
         Domoticz.Debug("Device & Mode is set to %d" % self.devMode)
 
+        self.pollInterval = int(Parameters["Mode3"]) * 5
+
         self.expertMode = (self.devMode > 1 and Parameters["Mode5"] == "Enabled")
         if self.expertMode:
             Domoticz.Debug("Expert mode and devices enabled")
@@ -146,103 +187,86 @@ class BasePlugin:
             if self.expertMode:
                 SetupExpertDevicesZPS(self)
 
+        ConfigureUpdates(self)
+
+        # All bus I/O is done by the worker; messages are handed back through its result queue
+        self.metrics = Metrics()
+        self.connection = Connection(self.devAddr, self.serial_parameters, self.metrics)
+        self.worker = BusWorker(self)
+        self.retryPolicy = RetryPolicy(self.maxAttempts, self.retryBaseDelay, self.retryMaxDelay)
+        self.breaker = CircuitBreaker(self.breakerThreshold, self.breakerProbeInterval, self.breakerMaxProbeInterval, onChange=self.worker.onBreaker)
+        self.metrics.addSource('breaker', self.breaker.stats)
+        if self.devMode == 1 or self.devMode == 2:
+            self.dev = PCWU(self.conHardId, self.conSoftId, self.devHardId, self.devSoftId, self.worker.onMessage)
+            self.onMessage = self.onMessagePCWU
+        elif self.devMode == 3:
+            self.dev = ZPS(self.conHardId, self.conSoftId, self.devHardId, self.devSoftId, self.worker.onMessage)
+            self.onMessage = self.onMessageZPS
+        self.dev.setMetrics(self.metrics)
+        self.metrics.addSource('updates', self.updates.stats)
+        self.writes = WriteQueue(self.dev, self.writeWindow)
+        if self.historyPath:
+            self.history = HistoryStore(self.historyPath, type(self.dev))
+        if self.devMode > 1:
+            PlanReads(self)
+        self.worker.start()
+        if self.devMode == 1:
+            self.sniffer = CycleSniffer(self.dev, onSync=self.worker.onSync)
+            self.metrics.addSource('sniffer', self.sniffer.stats)
+            self.worker.enqueue(BusWorker.PRIORITY_POLL, BusWorker.SNIFF)
+
         DumpConfigToLog()
 
         Domoticz.Heartbeat(5)
 
     def onStop(self):
         Domoticz.Debug("onStop called")
+        if self.worker:
+            self.worker.stop()
+        if self.connection:
+            self.connection.close()
+            Domoticz.Debug("Connection stats: %d connects, %d reconnects, %d failures" % (self.connection.connects, self.connection.reconnects, self.connection.failures))
+        if self.sniffer:
+            Domoticz.Debug("Sniffer stats: %d cycles, %d damaged cycles, %d stray frames, %d losses of sync" % (self.sniffer.cycles, self.sniffer.damagedCycles, self.sniffer.strayFrames, self.sniffer.losses))
+        if self.history:
+            self.history.close()
 
     def onMessagePCWU(self, dev, h, sh, m):
         Domoticz.Debug("onMessagePCWU called")
         if (self.devMode == 1 and sh["FNC"] == 0x60) or (self.devMode == 2 and sh["FNC"] == 0x50):
-            mp = dev.parseRegisters(sh["RestMessage"], sh["RegStart"], sh["RegLen"])
+            mp = dev.parseRegistersView(sh["RestMessage"], sh["RegStart"], sh["RegLen"])
 
             # Device status
             if 'WaitingStatus' in mp:
                 devReady, devStatus, devWaiting, devProgram, devError = PCWUStatus(mp)
                 self.devReady = devReady if self.devMode == 2 else False
 
-            # Temp and switch devices
-            for k,v in self.temp_devices.items():
-                if k in mp:
-                    Devices[v].Update(nValue=0, sValue=str(mp[k]))
-            for k,v in self.switch_devices.items():
-                if k in mp:
-                    newValue = int(mp[k])
-                    if newValue != Devices[v].nValue:
-                        Devices[v].Update(nValue=newValue, sValue="")
-
-            # Custom devices
-            for k,v in self.custom_devices.items():
-                if k == 'CompressorON - Count' and 'CompressorON' in mp and 'CompressorON' in self.custom_data:
-                    newValue = 1 if mp['CompressorON'] and not self.custom_data['CompressorON'] else 0
-                    Devices[v].Update(nValue=0, sValue=str(newValue))
-                elif k == 'CompressorON - Time' and 'CompressorON' in mp and 'CompressorONTime' in self.custom_data:
-                    newValue = round(time.time() - self.custom_data['CompressorONTime']) if mp['CompressorON'] else 0
-                    Devices[v].Update(nValue=0, sValue=str(newValue))
-                elif k == 'Delta T' and 'T6' in mp and 'T7' in mp and 'CompressorON' in self.custom_data:
-                    newValue = (mp['T7'] - mp['T6']) if self.custom_data['CompressorON'] else 0
-                    Devices[v].Update(nValue=0, sValue=str(newValue))
-                elif k in mp:
-                    Devices[v].Update(nValue=0, sValue=str(mp[k]))
+            # Temp, switch, custom and expert devices
+            DispatchRegisters(self, mp)
+
+            if self.history:
+                self.history.append(mp, self.messageTime)
 
+            # Times are those the messages arrived on the bus, not when they are handled
             if 'CompressorON' in mp:
+                if not mp['CompressorON'] or 'CompressorONTime' not in self.custom_data:
+                    self.custom_data['CompressorONTime'] = self.messageTime
                 self.custom_data['CompressorON'] = mp['CompressorON']
-                self.custom_data['CompressorONTime'] = time.time()
-
-            # Expert devices
-            if self.expertMode:
-                for k,v in self.x_switch_devices.items():
-                    if k in mp:
-                        newValue = int(mp[k])
-                        if newValue != Devices[v].nValue:
-                            Devices[v].Update(nValue=newValue, sValue="")
-                for k,v in self.x_custom_devices.items():
-                    if k in mp:
-                        if k == 'InstallationScheme':
-                            newValue = min(max(int(mp[k]), 1), 9) * 10
-                        elif k == 'WaterPumpOperationMode':
-                            newValue = min(max(int(mp[k]), 0), 1) * 10
-                        else:
-                            newValue = min(max(int(mp[k]), 0), 2) * 10
-                        Devices[v].Update(nValue=0, sValue=str(newValue))
 
     def onMessageZPS(self, dev, h, sh, m):
         Domoticz.Debug("onMessageZPS called")
         if (sh["FNC"] == 0x50):
-            mp = dev.parseRegisters(sh["RestMessage"], sh["RegStart"], sh["RegLen"])
+            mp = dev.parseRegistersView(sh["RestMessage"], sh["RegStart"], sh["RegLen"])
 
             # Device status
             if self.devMode == 3:
                 self.devReady = True
 
-            # Temp and switch devices
-            for k,v in self.temp_devices.items():
-                if k in mp:
-                    Devices[v].Update(nValue=0, sValue=str(mp[k]))
-            for k,v in self.switch_devices.items():
-                if k in mp:
-                    newValue = int(mp[k])
-                    if newValue != Devices[v].nValue:
-                        Devices[v].Update(nValue=newValue, sValue="")
-
-            # Custom devices
-            for k,v in self.custom_devices.items():
-                if k == 'SWH kWh Total' and 'TotalEnergy' in mp:
-                    Devices[v].Update(nValue=0, sValue=str(mp['TotalEnergy']))
-                elif k == 'SWH Generation' and 'TotalEnergy' in mp and 'CollectorPower' in mp:
-                    Devices[v].Update(nValue=0, sValue=str(mp['CollectorPower'])+";"+str(mp['TotalEnergy'] * 1000))
-                elif k == 'SWH Consumption' and 'Consumption' in mp:
-                    Devices[v].Update(nValue=0, sValue=str(mp['Consumption'])+";0")
-
-            # Expert devices
-            if self.expertMode:
-                for k,v in self.x_switch_devices.items():
-                    if k in mp:
-                        newValue = int(mp[k])
-                        if newValue != Devices[v].nValue:
-                            Devices[v].Update(nValue=newValue, sValue="")
+            # Temp, switch, custom and expert devices
+            DispatchRegisters(self, mp)
+
+            if self.history:
+                self.history.append(mp, self.messageTime)
 
     def onCommand(self, Unit, Command, Level, Hue):
         Domoticz.Debug("onCommand called for unit %d with command %s, level %s." % (Unit, Command, Level))
@@ -252,37 +276,37 @@ class BasePlugin:
             # PCWU specific command handling
             if (self.devMode == 2):
                 if (Unit == 5) and (Command == "Set Level"):
-                    SendCommand(self, 'setTapWaterTemp', Level)
-                    Devices[Unit].Update(nValue=0, sValue=str(Level))
+                    QueueWrite(self, 'TapWaterTemp', Level)
+                    self.updates.publish(Unit, 0, str(Level))
 
             # ZPS specific command handling
             elif (self.devMode == 3):
                 if (Unit == 9) and (Command == "Set Level"):
-                    SendCommand(self, 'setTemp', 'NightCoolingStartTemp', Level)
-                    Devices[Unit].Update(nValue=0, sValue=str(Level))
+                    QueueWrite(self, 'NightCoolingStartTemp', Level)
+                    self.updates.publish(Unit, 0, str(Level))
                 elif (Unit == 10) and (Command == "Set Level"):
-                    SendCommand(self, 'setTemp', 'NightCoolingStopTemp', Level)
-                    Devices[Unit].Update(nValue=0, sValue=str(Level))
+                    QueueWrite(self, 'NightCoolingStopTemp', Level)
+                    self.updates.publish(Unit, 0, str(Level))
                 elif (Unit == 11) and (Command == "Set Level"):
-                    SendCommand(self, 'setTemp', 'CollectorPumpMaxTemp', Level)
-                    Devices[Unit].Update(nValue=0, sValue=str(Level))
+                    QueueWrite(self, 'CollectorPumpMaxTemp', Level)
+                    self.updates.publish(Unit, 0, str(Level))
                 elif (Unit == 12) and (Command == "Set Level"):
-                    SendCommand(self, 'setTemp', 'CollectorOverheatProtMaxTemp', Level)
-                    Devices[Unit].Update(nValue=0, sValue=str(Level))
+                    QueueWrite(self, 'CollectorOverheatProtMaxTemp', Level)
+                    self.updates.publish(Unit, 0, str(Level))
 
             # Generic switch command handling
             if (self.devMode > 1):
                 for k,v in self.switch_devices.items():
                     if (Unit == v):
                         nValue = 1 if (Command == "On") else 0
-                        SendCommand(self, 'writeRegister', k, nValue)
-                        Devices[Unit].Update(nValue=nValue, sValue="")
+                        QueueWrite(self, k, nValue)
+                        self.updates.publish(Unit, nValue, "")
                 if self.expertMode:
                     for k,v in self.x_switch_devices.items():
                         if (Unit == v):
                             nValue = 1 if (Command == "On") else 0
-                            SendCommand(self, 'writeRegister', k, nValue)
-                            Devices[Unit].Update(nValue=nValue, sValue="")
+                            QueueWrite(self, k, nValue)
+                            self.updates.publish(Unit, nValue, "")
                     for k,v in self.x_custom_devices.items():
                         if (Unit == v):
                             if k == 'InstallationScheme':
@@ -291,8 +315,8 @@ class BasePlugin:
                                 nValue = min(max(int(Level / 10), 0), 1)
                             else:
                                 nValue = min(max(int(Level / 10), 0), 2)
-                            SendCommand(self, 'writeRegister', k, nValue)
-                            Devices[Unit].Update(nValue=0, sValue=str(Level))
+                            QueueWrite(self, k, nValue)
+                            self.updates.publish(Unit, 0, str(Level))
 
             return True     # TODO - check if command actually succeeded
 
@@ -303,32 +327,80 @@ class BasePlugin:
     def onHeartbeat(self):
         Domoticz.Debug("onHeartbeat called %d" % self.lastPolled)
 
-        if self.lastPolled == 0:
-            attempt = 1
+        start = time.monotonic()
+        if self.profileHeartbeats:
+            _, self.lastProfile = profileCall(self.heartbeat)
+            for line in self.lastProfile.splitlines():
+                Domoticz.Debug(line)
+        else:
+            self.heartbeat()
+        self.metrics.observe('heartbeat_seconds', time.monotonic() - start)
+
+        if self.metricsPath:
+            try:
+                self.metrics.writePrometheus(self.metricsPath)
+            except OSError as e:
+                Domoticz.Error("Failed to write metrics to %s; %s" % (self.metricsPath, e))
+
+    def heartbeat(self):
+        self.processResults()
+
+        # Eavesdropping runs continuously on the worker; only direct comms are polled
+        if self.lastPolled == 0 and self.devMode > 1:
+            if self.pollsPending > 0:
+                Domoticz.Debug("Previous poll still pending, skipping...")
+            elif not self.breaker.allow():
+                Domoticz.Debug("%s unreachable, next probe in %d s" % (self.devAddr, self.breaker.timeUntilProbe()))
+            else:
+                QueuePoll(self, 'readRegisterRanges', self.readPlan)
 
-            while True:
-                if attempt <= self.maxAttempts:
-                    if attempt > 1:
-                        Domoticz.Debug("Previous attempt failed, trying again...")
-                else:
-                    Domoticz.Error("Failed to retrieve data from %s, cancelling..." % self.devAddr)
-                    break
-                attempt += 1
+        self.lastPolled += 1
+        self.lastPolled %= int(Parameters["Mode3"])
 
-                try:
-                    if (self.devMode == 1):
-                        SendCommand(self, 'eavesDrop')
+    # Handle messages and results of the worker; runs on the plugin thread
+    def processResults(self):
+        while True:
+            try:
+                result = self.worker.results.get_nowait()
+            except queue.Empty:
+                break
+            kind = result[0]
+            if kind == BusWorker.RESULT_MESSAGE:
+                self.messageTime = result[5]
+                start = time.monotonic()
+                self.onMessage(*result[1:5])
+                self.metrics.observe('message_handler_seconds', time.monotonic() - start)
+            elif kind == BusWorker.RESULT_RETRY:
+                self.metrics.inc('retries_total')
+                Domoticz.Debug("Previous attempt of %s failed, trying again... (%s)" % (result[1], result[2]))
+            elif kind == BusWorker.RESULT_BREAKER:
+                if result[1] == OPEN:
+                    Domoticz.Error("%s unreachable, polling suspended; probing every %d s" % (self.devAddr, self.breaker.interval))
+                else:
+                    Domoticz.Log("%s reachable again, polling resumed" % self.devAddr)
+            elif kind == BusWorker.RESULT_SYNC:
+                if result[1]:
+                    Domoticz.Debug("Locked to bus cycle of %s" % self.devAddr)
+                else:
+                    Domoticz.Log("Lost bus cycle of %s, waiting for next cycle..." % self.devAddr)
+            elif kind == BusWorker.RESULT_DONE:
+                _, priority, command, error = result
+                if priority == BusWorker.PRIORITY_POLL:
+                    self.pollsPending -= 1
+                if error is not None:
+                    if priority == BusWorker.PRIORITY_POLL:
+                        Domoticz.Log("Exception from %s; %s" % (self.devAddr, error))
+                        Domoticz.Error("Failed to retrieve data from %s, cancelling..." % self.devAddr)
                     else:
-                        SendCommand(self, 'readStatusRegisters')
-                        SendCommand(self, 'readConfigRegisters')
-                except Exception as e:
-                    Domoticz.Log("Exception from %s; %s" % (self.devAddr, e))
+                        Domoticz.Error("Command %s to %s failed; %s" % (command, self.devAddr, error))
                     self.devReady = False
-                else:
-                    break
+                elif command == 'readRegisterRanges' and self.dev.numResponses:
+                    Domoticz.Debug("Response latency: avg %.1f ms, max %.1f ms over %d responses" % (self.dev.totalLatency / self.dev.numResponses * 1000, self.dev.maxLatency * 1000, self.dev.numResponses))
 
-        self.lastPolled += 1
-        self.lastPolled %= int(Parameters["Mode3"])
+        # Only the last value per device of all messages handled above is written
+        start = time.monotonic()
+        self.updates.flush()
+        self.metrics.observe('domoticz_update_seconds', time.monotonic() - start)
 
 
 global _plugin
@@ -376,6 +448,9 @@ PCWU_ERROR_LOWPRES = 10     # Low pressure (alarm 17)
 PCWU_ERROR_HIGHPRES = 20    # High pressure (alarm 18)
 PCWU_ERROR_OVERTEMP = 30    # Over temp (alarm 21)
 
+# Registers PCWUStatus needs, all in one message
+PCWU_STATUS_REGISTERS = ('IsManual', 'WaitingStatus', 'WaitingTimer', 'FanON')
+
 def PCWUStatus(mp):
     devReady = False
     devStatus = PCWU_STATUS_OFF
@@ -445,6 +520,63 @@ def SetupDevice(unit, name, *args, **kwargs):
         Domoticz.Device(Name=name, Unit=unit, *args, **kwargs).Create()
     return unit
 
+# Register dispatch index
+#
+# Maps each register name to the devices which consume it, so a message only
+# touches the registers it contains instead of every device checking every
+# message. Handlers are called as handler(plugin, unit, mp, reg) and only when
+# the other registers they require are in the same message.
+def AddDispatch(plugin, reg, unit, handler, requires=()):
+    plugin.dispatch.setdefault(reg, []).append((unit, handler, requires))
+
+def DispatchRegisters(plugin, mp):
+    dispatch = plugin.dispatch
+    for k in mp:
+        for unit, handler, requires in dispatch.get(k, ()):
+            if all(r in mp for r in requires):
+                handler(plugin, unit, mp, k)
+
+def AddDispatchDevices(plugin, devices, handler):
+    for k,v in devices.items():
+        AddDispatch(plugin, k, v, handler)
+
+def ValueHandler(plugin, unit, mp, k):
+    plugin.updates.set(unit, 0, str(mp[k]))
+
+def SwitchHandler(plugin, unit, mp, k):
+    plugin.updates.set(unit, int(mp[k]), "")
+
+def SelectorHandler(minLevel, maxLevel):
+    def handler(plugin, unit, mp, k):
+        plugin.updates.set(unit, 0, str(min(max(int(mp[k]), minLevel), maxLevel) * 10))
+    return handler
+
+def CompressorCountHandler(plugin, unit, mp, k):
+    if 'CompressorON' in plugin.custom_data:
+        newValue = 1 if mp['CompressorON'] and not plugin.custom_data['CompressorON'] else 0
+        plugin.updates.set(unit, 0, str(newValue))
+
+# Seconds the compressor ran since the previous message. Only whole seconds are
+# counted; the rest is carried over to the next message.
+def CompressorTimeHandler(plugin, unit, mp, k):
+    if 'CompressorONTime' in plugin.custom_data:
+        newValue = 0
+        if mp['CompressorON']:
+            newValue = max(0, int(plugin.messageTime - plugin.custom_data['CompressorONTime']))
+            plugin.custom_data['CompressorONTime'] += newValue
+        plugin.updates.set(unit, 0, str(newValue))
+
+def DeltaTHandler(plugin, unit, mp, k):
+    if 'CompressorON' in plugin.custom_data:
+        newValue = (mp['T7'] - mp['T6']) if plugin.custom_data['CompressorON'] else 0
+        plugin.updates.set(unit, 0, str(newValue))
+
+def SWHGenerationHandler(plugin, unit, mp, k):
+    plugin.updates.set(unit, 0, str(mp['CollectorPower'])+";"+str(mp['TotalEnergy'] * 1000))
+
+def SWHConsumptionHandler(plugin, unit, mp, k):
+    plugin.updates.set(unit, 0, str(mp['Consumption'])+";0")
+
 def SetupDevicesPCWU(plugin):
     plugin.temp_devices = {
         'T1': SetupDevice(1, "T1 (ambient)", TypeName='Temperature'),
@@ -469,6 +601,14 @@ def SetupDevicesPCWU(plugin):
         'Delta T': SetupDevice(28, "Delta T", TypeName="Custom", Options={"Custom": "1;°"}),
     }
 
+    plugin.dispatch = {}
+    AddDispatchDevices(plugin, plugin.temp_devices, ValueHandler)
+    AddDispatchDevices(plugin, plugin.switch_devices, SwitchHandler)
+    AddDispatch(plugin, 'CompressorON', plugin.custom_devices['CompressorON - Count'], CompressorCountHandler)
+    AddDispatch(plugin, 'CompressorON', plugin.custom_devices['CompressorON - Time'], CompressorTimeHandler)
+    AddDispatch(plugin, 'T7', plugin.custom_devices['Delta T'], DeltaTHandler, ('T6',))
+    AddDispatch(plugin, 'EV1', plugin.custom_devices['EV1'], ValueHandler)
+
 def SetupExpertDevicesPCWU(plugin):
 
     plugin.x_switch_devices = {
@@ -493,6 +633,15 @@ def SetupExpertDevicesPCWU(plugin):
         'FanOperationMode': SetupDevice(32, "X - Fan Operation Mode", TypeName="Selector Switch", Image=11, Options={"LevelActions": "||", "LevelNames": "Max|Min|Day/Night"}),
     }
 
+    AddDispatchDevices(plugin, plugin.x_switch_devices, SwitchHandler)
+    for k,v in plugin.x_custom_devices.items():
+        if k == 'InstallationScheme':
+            AddDispatch(plugin, k, v, SelectorHandler(1, 9))
+        elif k == 'WaterPumpOperationMode':
+            AddDispatch(plugin, k, v, SelectorHandler(0, 1))
+        else:
+            AddDispatch(plugin, k, v, SelectorHandler(0, 2))
+
 def SetupDevicesZPS(plugin):
     plugin.temp_devices = {
         'T1': SetupDevice(1, "T1 (collectors)", TypeName='Temperature'),
@@ -516,6 +665,13 @@ def SetupDevicesZPS(plugin):
         'SWH Consumption': SetupDevice(7, "SWH Consumption", TypeName='kWh', Options={'EnergyMeterMode':'1'}),
     }
 
+    plugin.dispatch = {}
+    AddDispatchDevices(plugin, plugin.temp_devices, ValueHandler)
+    AddDispatchDevices(plugin, plugin.switch_devices, SwitchHandler)
+    AddDispatch(plugin, 'TotalEnergy', plugin.custom_devices['SWH kWh Total'], ValueHandler)
+    AddDispatch(plugin, 'CollectorPower', plugin.custom_devices['SWH Generation'], SWHGenerationHandler, ('TotalEnergy',))
+    AddDispatch(plugin, 'Consumption', plugin.custom_devices['SWH Consumption'], SWHConsumptionHandler)
+
 def SetupExpertDevicesZPS(plugin):
     plugin.x_switch_devices = {
         'AlarmSoundEnabled': SetupDevice(16, "X - Alarm Sound Enabled", TypeName='Switch', Image=9),
@@ -528,26 +684,333 @@ def SetupExpertDevicesZPS(plugin):
     }
     plugin.x_custom_devices = {}
 
-def SendCommand(plugin, command, *args, **kwargs):
-    if plugin.devAddr.startswith("socket://"):
-        ser = serial.serial_for_url(plugin.devAddr)
-    else:
-        ser = serial.Serial(plugin.devAddr, **plugin.serial_parameters)
-    dev = None
+    AddDispatchDevices(plugin, plugin.x_switch_devices, SwitchHandler)
+
+# Deadband and coalescing filter for Domoticz device updates
+#
+# Every Update call is a database write in Domoticz, while most values on the
+# bus don't change from one frame to the next. Values set on the filter are
+# held until flush, so all frames of one poll or eavesdrop window collapse into
+# a single update per device with the last value. On flush a device is only
+# updated if its value changed by more than its deadband (any change for non
+# numeric values) and it wasn't updated less than minInterval seconds ago, or
+# if it wasn't updated for maxInterval seconds (None = only on change).
+# Incremental counter devices are summed instead of overwritten and only
+# updated when the sum isn't zero (or maxInterval passed).
+class UpdateFilter:
+
+    def __init__(self, minInterval=0, maxInterval=None):
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.units = {}         # Unit => (deadband, minInterval, maxInterval, incremental)
+        self.published = {}     # Unit => (nValue, sValue, time) of last update
+        self.pending = {}       # Unit => (nValue, sValue) to be written on flush
+        self.written = 0        # Number of updates written to Domoticz
+        self.suppressed = 0     # Number of updates not written
+
+    def configure(self, unit, deadband=0, minInterval=None, maxInterval=None, incremental=False):
+        self.units[unit] = (
+            deadband,
+            self.minInterval if minInterval is None else minInterval,
+            maxInterval,
+            incremental
+        )
 
-    if (plugin.devMode == 1) or (plugin.devMode == 2):
-        dev = PCWU(plugin.conHardId, plugin.conSoftId, plugin.devHardId, plugin.devSoftId, plugin.onMessagePCWU)
-    elif (plugin.devMode == 3):
-        dev = ZPS(plugin.conHardId, plugin.conSoftId, plugin.devHardId, plugin.devSoftId, plugin.onMessageZPS)
+    def getConfig(self, unit):
+        return self.units.get(unit, (0, self.minInterval, self.maxInterval, False))
+
+    def set(self, unit, nValue, sValue):
+        if self.getConfig(unit)[3] and unit in self.pending:
+            sValue = str(int(self.pending[unit][1]) + int(sValue))
+            self.suppressed += 1
+        elif unit in self.pending:
+            self.suppressed += 1
+        self.pending[unit] = (nValue, sValue)
+
+    # Update a device right away, eg. to give feedback on a user command
+    def publish(self, unit, nValue, sValue, now=None):
+        self.pending.pop(unit, None)
+        self.write(unit, nValue, sValue, time.time() if now is None else now)
+
+    def write(self, unit, nValue, sValue, now):
+        Devices[unit].Update(nValue=nValue, sValue=sValue)
+        self.published[unit] = (nValue, sValue, now)
+        self.written += 1
+
+    def flush(self, now=None):
+        if now is None:
+            now = time.time()
+        pending = self.pending
+        self.pending = {}
+        for unit, (nValue, sValue) in pending.items():
+            if unit not in Devices:
+                continue
+            if self.isDue(unit, nValue, sValue, now):
+                self.write(unit, nValue, sValue, now)
+            elif self.getConfig(unit)[3] and sValue != "0":
+                self.pending[unit] = (nValue, sValue)    # Don't lose increments held back by minInterval
+            else:
+                self.suppressed += 1
+
+    def stats(self):
+        return {
+            'written': self.written,
+            'suppressed': self.suppressed,
+        }
+
+    def isDue(self, unit, nValue, sValue, now):
+        deadband, minInterval, maxInterval, incremental = self.getConfig(unit)
+        last = self.published.get(unit, None)
+        if last is None:
+            # Nothing written since start; compare against the current value of the device
+            last = (Devices[unit].nValue, Devices[unit].sValue, None)
+        lastnValue, lastsValue, lastTime = last
+        age = None if lastTime is None else now - lastTime
+        if age is not None and age < minInterval:
+            return False
+        if maxInterval is not None and (age is None or age >= maxInterval):
+            return True
+        if incremental:
+            return IsChanged(sValue, "0", 0)
+        return nValue != lastnValue or IsChanged(sValue, lastsValue, deadband)
+
+# Values are read with 0.1 resolution, so a difference like 20.1 - 20.0 may come
+# out just above or below 0.1; this much is allowed for
+DEADBAND_TOLERANCE = 1e-6
+
+# Did a (';' separated) sValue change by more than deadband?
+def IsChanged(sValue, lastsValue, deadband):
+    parts = sValue.split(";")
+    lastParts = lastsValue.split(";")
+    if len(parts) != len(lastParts):
+        return True
+    for part, lastPart in zip(parts, lastParts):
+        try:
+            if abs(float(part) - float(lastPart)) > deadband + DEADBAND_TOLERANCE:
+                return True
+        except ValueError:
+            if part != lastPart:
+                return True
+    return False
+
+def ConfigureUpdates(plugin):
+    minInterval = plugin.updateMinInterval
+    if plugin.devMode == 1:
+        # The sniffer sees every bus cycle; the query interval limits how often devices are updated
+        minInterval = max(minInterval, plugin.pollInterval)
+    plugin.updates = UpdateFilter(minInterval, plugin.updateMaxInterval)
+    for unit in plugin.temp_devices.values():
+        plugin.updates.configure(unit, deadband=plugin.tempDeadband, maxInterval=plugin.updateMaxInterval)
+    for unit in itertools.chain(plugin.switch_devices.values(), plugin.x_switch_devices.values(), plugin.x_custom_devices.values()):
+        plugin.updates.configure(unit, maxInterval=None)
+    for k, unit in plugin.custom_devices.items():
+        if k in ('CompressorON - Count', 'CompressorON - Time'):
+            plugin.updates.configure(unit, maxInterval=plugin.updateMaxInterval, incremental=True)
+        elif k == 'Delta T':
+            plugin.updates.configure(unit, deadband=plugin.tempDeadband, maxInterval=plugin.updateMaxInterval)
+        else:
+            plugin.updates.configure(unit, maxInterval=plugin.updateMaxInterval)
+
+# Raised when a command is queued while the worker is busy with a poll
+class Preempted(Exception):
+    pass
+
+# Background bus worker
+#
+# Owns the connection and device of the plugin. Callbacks only enqueue work;
+# user commands have priority over background polls, so a command never waits
+# for more than the request currently on the bus. Messages received and the
+# outcome of each command are passed back through the result queue, which is
+# drained on the plugin thread as the Domoticz API is not thread safe.
+class BusWorker(threading.Thread):
+    PRIORITY_STOP = 0
+    PRIORITY_COMMAND = 1
+    PRIORITY_POLL = 2
+
+    WAKEUP = 'wakeup'       # No-op command; makes the worker reconsider pending writes
+    SNIFF = 'sniff'         # Eavesdrop until another command is queued, then requeue
+
+    RESULT_MESSAGE = 0      # (RESULT_MESSAGE, dev, h, sh, m, time received)
+    RESULT_RETRY = 1        # (RESULT_RETRY, command, error)
+    RESULT_DONE = 2         # (RESULT_DONE, priority, command, error or None)
+    RESULT_SYNC = 3         # (RESULT_SYNC, locked)
+    RESULT_BREAKER = 4      # (RESULT_BREAKER, state)
+
+    def __init__(self, plugin):
+        super().__init__(name="HewalexBusWorker", daemon=True)
+        self.plugin = plugin
+        self.commands = queue.PriorityQueue()
+        self.results = queue.Queue()
+        self.seq = itertools.count()    # Keeps commands of equal priority in order
+
+    def enqueue(self, priority, command, *args, **kwargs):
+        self.commands.put((priority, next(self.seq), command, args, kwargs))
+
+    def stop(self, timeout=5):
+        self.enqueue(self.PRIORITY_STOP, None)
+        self.join(timeout)
+
+    def onMessage(self, dev, h, sh, m):
+        self.results.put((self.RESULT_MESSAGE, dev, h, sh, m, time.time()))
+
+    def onSync(self, sniffer, locked):
+        self.results.put((self.RESULT_SYNC, locked))
+
+    def onBreaker(self, breaker, state):
+        self.results.put((self.RESULT_BREAKER, state))
+
+    def commandsPending(self):
+        return not self.commands.empty()
+
+    # Is a command (or stop) waiting, rather than only polls?
+    def commandWaiting(self):
+        with self.commands.mutex:
+            return bool(self.commands.queue) and self.commands.queue[0][0] < self.PRIORITY_POLL
+
+    # Wait for up to delay seconds or until a command is queued
+    def idle(self, delay):
+        deadline = time.monotonic() + delay
+        with self.commands.not_empty:
+            while not (self.commands.queue and self.commands.queue[0][0] < self.PRIORITY_POLL):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                self.commands.not_empty.wait(remaining)
+
+    # Wait between retries of a poll, sending writes as they fall due. A
+    # command queued meanwhile preempts the poll.
+    def backoff(self, delay):
+        deadline = time.monotonic() + delay
+        while not self.commandWaiting():
+            self.flushWrites()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            due = self.plugin.writes.timeUntilDue()
+            self.idle(remaining if due is None else min(remaining, due))
+        raise Preempted()
+
+    def run(self):
+        while True:
+            try:
+                priority, _, command, args, kwargs = self.commands.get(timeout=self.plugin.writes.timeUntilDue())
+            except queue.Empty:
+                self.flushWrites()
+                continue
+            if command is None:
+                self.flushWrites(force=True)
+                break
+            self.flushWrites()
+            if command == self.WAKEUP:
+                continue
+            if command == self.SNIFF:
+                self.sniff()
+                continue
+            if command == 'readRegisterRanges':
+                try:
+                    error = self.readRanges(*args, **kwargs)
+                except Preempted:
+                    continue
+            else:
+                attempts = None if priority == self.PRIORITY_POLL else 1
+                try:
+                    self.plugin.retryPolicy.call(SendCommand, self.plugin, command, *args, attempts=attempts, sleep=self.backoff,
+                        onRetry=lambda attempt, e: self.results.put((self.RESULT_RETRY, command, e)), **kwargs)
+                except Preempted:
+                    # Tried again after the command
+                    self.enqueue(priority, command, *args, **kwargs)
+                    continue
+                except Exception as e:
+                    error = e
+                else:
+                    error = None
+            self.results.put((self.RESULT_DONE, priority, command, error))
+
+    # Read the ranges of a poll one request frame at a time. A failed frame is
+    # retried on its own, with backoff; frames read before it are kept. Returns
+    # the last error, if any. Stops as soon as the circuit breaker opens; while
+    # probing there are no retries. A command queued meanwhile goes first: the
+    # ranges not read yet are queued as a new poll and Preempted is raised.
+    def readRanges(self, ranges, error=None):
+        plugin = self.plugin
+        breaker = plugin.breaker
+        for i, (start, num) in enumerate(ranges):
+            request = "readRegisters %d+%d" % (start, num)
+            self.flushWrites()
+            try:
+                if self.commandWaiting():
+                    raise Preempted()
+                plugin.retryPolicy.call(self.readRange, start, num, attempts=1 if breaker.isProbing() else None, sleep=self.backoff,
+                    onRetry=lambda attempt, e: self.results.put((self.RESULT_RETRY, request, e)))
+            except Preempted:
+                self.enqueue(self.PRIORITY_POLL, 'readRegisterRanges', ranges[i:], error)
+                raise
+            except Exception as e:
+                error = e
+                if breaker.failure():
+                    break
+            else:
+                breaker.success()
+        return error
+
+    def readRange(self, start, num):
+        dev = self.plugin.dev
+        self.plugin.connection.call(dev.readRegisters, start, num)
+        if dev.lastLatency is None:
+            raise Exception("No response to read of %d registers from %d" % (num, start))
+
+    # The sniffer never flushes the port; it gives way to other commands and
+    # picks up where it left off once they are done
+    def sniff(self):
+        try:
+            self.plugin.connection.call(self.plugin.sniffer.run, stop=self.commandsPending)
+        except Exception as e:
+            self.results.put((self.RESULT_RETRY, self.SNIFF, e))
+            self.plugin.sniffer.reset()
+            self.idle(self.plugin.sniffRetryDelay)
+        self.enqueue(self.PRIORITY_POLL, self.SNIFF)
+
+    def flushWrites(self, force=False):
+        for start, num, values in self.plugin.writes.take(force=force):
+            try:
+                # Rewriting a value the plugin wrote itself since the last poll is skipped
+                self.plugin.connection.call(self.plugin.dev.writeRegisters, start, num, values, maxAge=self.plugin.pollInterval)
+            except Exception as e:
+                error = e
+            else:
+                error = None
+            self.results.put((self.RESULT_DONE, self.PRIORITY_COMMAND, 'writeRegisters', error))
+
+# Register writes are debounced and coalesced before the worker sends them
+def QueueWrite(plugin, regName, val):
+    plugin.writes.add(regName, plugin.dev.encodeRegister(regName, val))
+    plugin.worker.enqueue(BusWorker.PRIORITY_COMMAND, BusWorker.WAKEUP)
+
+# Plan the reads of a poll so only the registers consumed by devices, device
+# handlers and the device status are fetched
+def PlanReads(plugin):
+    names = set(plugin.dispatch)
+    for entries in plugin.dispatch.values():
+        for unit, handler, requires in entries:
+            names.update(requires)
+    if plugin.devMode == 2:
+        names.update(PCWU_STATUS_REGISTERS)
+    plugin.readPlan = plugin.dev.planReads(names, plugin.serial_parameters['baudrate'])
+    Domoticz.Debug("Poll reads %s" % ", ".join("%d+%d" % read for read in plugin.readPlan))
+
+def QueuePoll(plugin, command, *args, **kwargs):
+    plugin.pollsPending += 1
+    plugin.worker.enqueue(BusWorker.PRIORITY_POLL, command, *args, **kwargs)
+
+def SendCommand(plugin, command, *args, **kwargs):
+    dev = plugin.dev
 
     if dev:
         if (command == 'eavesDrop'):
-            dev.eavesDrop(ser, 1, *args, **kwargs)
+            plugin.connection.call(dev.eavesDrop, 1, *args, **kwargs)
         else:
             command_method = getattr(dev, command)
-            command_method(ser, *args, **kwargs)
-
-    ser.close()
+            plugin.connection.call(command_method, *args, **kwargs)
 
 def DumpConfigToLog():
     for x in Parameters: